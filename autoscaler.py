@@ -0,0 +1,282 @@
+import threading
+import logging
+import math
+import random
+import os
+
+# Starting per-URL latency guesses in seconds, including the pause between requests
+DEFAULT_LATENCY = {
+    'kaspi': 4.0,
+    'alibaba': 4.0,
+    'wildberries': 12.0,
+    'ozon': 6.0
+}
+
+
+def host_resources():
+    """Return (cpu, memory) utilisation of the host as fractions of 1"""
+    cpu_count = os.cpu_count() or 1
+    try:
+        cpu = os.getloadavg()[0] / cpu_count
+    except OSError:
+        cpu = 0.0
+
+    memory = 0.0
+    try:
+        meminfo = {}
+        with open('/proc/meminfo') as f:
+            for line in f:
+                key, value = line.split(':', 1)
+                meminfo[key] = int(value.split()[0])
+        memory = 1 - meminfo['MemAvailable'] / meminfo['MemTotal']
+    except (OSError, KeyError, ValueError):
+        pass
+    return cpu, memory
+
+
+class ThroughputSample:
+    """Thread-safe counters filled by the workers during one wave.
+
+    The caller sets wall to the wave's elapsed time once every worker has
+    finished, so the controller sees throughput including setup, stragglers
+    and the wait at the end of the wave.
+    """
+
+    def __init__(self, workers=0):
+        self._lock = threading.Lock()
+        self.workers = workers
+        self.wall = 0.0
+        self.urls = 0
+        self.latency = 0.0
+        self.setup = 0.0
+        self.errors = 0
+        self.bans = 0
+
+    def record(self, seconds, error=False):
+        """Count one URL; error is for load-related (transient or blocked) failures only"""
+        with self._lock:
+            self.urls += 1
+            self.latency += seconds
+            if error:
+                self.errors += 1
+
+    def record_setup(self, seconds):
+        """Time a worker spent starting its browser or session and DB connection"""
+        with self._lock:
+            self.setup += seconds
+
+    def record_ban(self):
+        with self._lock:
+            self.bans += 1
+
+
+class MarketplaceState:
+    def __init__(self, workers, wave_size, latency):
+        self.workers = workers
+        self.wave_size = wave_size
+        self.latency = latency
+        self.error_rate = 0.0
+        self.ban_rate = 0.0
+        # Lowest worker count that drew bans, and ban-free waves since then
+        self.ban_ceiling = None
+        self.clean_waves = 0
+
+
+class AdaptiveController:
+    """AIMD controller for per-marketplace worker counts.
+
+    After every wave the measured per-URL latency, worker setup included, is
+    folded into an EWMA and the remaining URLs are projected against the
+    marketplace's deadline. While the projection misses the deadline, workers
+    are added in proportion to the gap (at most doubling per wave); they are
+    halved as soon as a wave's ban rate or the host CPU/memory crosses its
+    limit. The worker count that drew bans is remembered as a ceiling and
+    increases stop just below it; after probe_waves ban-free waves the
+    ceiling is raised by one so a site that relaxed can be re-probed.
+
+    Workers keep their browser and DB connection between waves, so only
+    concurrency is adjusted; the wave size (URLs per worker) just makes a
+    wave last about interval seconds, which is how often the controller
+    gets to re-plan.
+    """
+
+    def __init__(self, interval=60, min_workers=1, max_workers=8, initial_workers=3,
+                 min_wave=5, max_wave=100, ban_limit=0.1, error_limit=0.3,
+                 cpu_limit=0.85, memory_limit=0.85, smoothing=0.3, probe_waves=30,
+                 resource_probe=host_resources):
+        self.interval = interval
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.initial_workers = initial_workers
+        self.min_wave = min_wave
+        self.max_wave = max_wave
+        self.ban_limit = ban_limit
+        self.error_limit = error_limit
+        self.cpu_limit = cpu_limit
+        self.memory_limit = memory_limit
+        self.smoothing = smoothing
+        self.probe_waves = probe_waves
+        self.resource_probe = resource_probe
+        self.states = {}
+
+    def state(self, marketplace):
+        if marketplace not in self.states:
+            latency = DEFAULT_LATENCY.get(marketplace, 5.0)
+            self.states[marketplace] = MarketplaceState(
+                self.initial_workers, self._wave_for(latency), latency
+            )
+        return self.states[marketplace]
+
+    def _wave_for(self, latency):
+        return max(self.min_wave, min(self.max_wave, int(self.interval / max(latency, 0.1))))
+
+    def plan(self, marketplace):
+        """Return (workers, URLs per worker) for the next wave"""
+        state = self.state(marketplace)
+        return state.workers, state.wave_size
+
+    def estimated_seconds(self, marketplace, url_count):
+        """Projected wall time for url_count URLs at the current settings"""
+        state = self.state(marketplace)
+        return url_count * state.latency / state.workers
+
+    def observe(self, marketplace, sample, remaining_urls, seconds_left):
+        """Fold a finished wave into the estimates and adjust the plan"""
+        state = self.state(marketplace)
+        if sample.urls:
+            alpha = self.smoothing
+            if sample.wall and sample.workers:
+                # Worker-seconds per URL as actually delivered by the wave
+                latency = sample.wall * min(sample.workers, sample.urls) / sample.urls
+            else:
+                latency = (sample.latency + sample.setup) / sample.urls
+            state.latency = (1 - alpha) * state.latency + alpha * latency
+            state.error_rate = (1 - alpha) * state.error_rate + alpha * (sample.errors / sample.urls)
+            state.ban_rate = (1 - alpha) * state.ban_rate + alpha * (sample.bans / sample.urls)
+
+        wave_ban_rate = sample.bans / sample.urls if sample.urls else 0.0
+        if sample.bans:
+            state.clean_waves = 0
+        elif sample.urls:
+            state.clean_waves += 1
+            if state.ban_ceiling is not None and state.clean_waves >= self.probe_waves:
+                state.ban_ceiling = state.ban_ceiling + 1 if state.ban_ceiling < self.max_workers else None
+                state.clean_waves = 0
+
+        cpu, memory = self.resource_probe()
+        projected = remaining_urls * state.latency / state.workers
+        old_workers = state.workers
+        # Stay below the worker count that last drew bans
+        limit = self.max_workers if state.ban_ceiling is None else max(self.min_workers, state.ban_ceiling - 1)
+
+        if remaining_urls == 0:
+            reason = "pass finished"
+        elif wave_ban_rate > self.ban_limit:
+            state.ban_ceiling = min(state.workers, state.ban_ceiling or state.workers)
+            state.workers = max(self.min_workers, state.workers // 2)
+            reason = f"ban rate {wave_ban_rate:.1%} over {self.ban_limit:.0%}, ceiling {state.ban_ceiling}"
+        elif state.error_rate > self.error_limit:
+            state.workers = max(self.min_workers, state.workers // 2)
+            reason = f"error rate {state.error_rate:.1%} over {self.error_limit:.0%}"
+        elif cpu > self.cpu_limit or memory > self.memory_limit:
+            state.workers = max(self.min_workers, state.workers // 2)
+            reason = f"host saturated (cpu {cpu:.0%}, memory {memory:.0%})"
+        elif projected > seconds_left and state.workers < limit:
+            # Enough workers to close the projected gap, at most doubling per wave
+            needed = limit if seconds_left <= 0 else math.ceil(state.workers * projected / seconds_left)
+            state.workers = min(limit, needed, state.workers * 2)
+            reason = "behind deadline"
+        elif state.workers > limit:
+            state.workers = limit
+            reason = f"ban ceiling {state.ban_ceiling}"
+        elif state.workers > self.min_workers and projected * state.workers / (state.workers - 1) < seconds_left * 0.5:
+            # Comfortably ahead even with one worker less, so ease off the site
+            state.workers -= 1
+            reason = "well ahead of deadline"
+        else:
+            reason = "on track"
+
+        state.wave_size = self._wave_for(state.latency)
+        logging.info(
+            f"Autoscaler {marketplace}: workers {old_workers}->{state.workers} ({reason}), "
+            f"{state.wave_size} urls per worker per wave; "
+            f"latency {state.latency:.1f}s/url, errors {state.error_rate:.1%}, bans {state.ban_rate:.1%}, "
+            f"cpu {cpu:.0%}, memory {memory:.0%}, "
+            f"projected {projected:.0f}s for {remaining_urls} urls with {seconds_left:.0f}s left"
+        )
+        return reason
+
+
+class SimulatedMarketplace:
+    """Latency model for exercising the controller without browsers.
+
+    Each URL takes base_latency seconds plus jitter; once more than
+    ban_workers run concurrently, every URL is banned with ban_probability.
+    A newly started worker first spends setup_seconds launching its browser.
+    URLs go to whichever worker is free first, like main's shared queue.
+    """
+
+    def __init__(self, base_latency, jitter=0.3, ban_workers=6, ban_probability=0.3, error_probability=0.02,
+                 setup_seconds=8.0, seed=None):
+        self.base_latency = base_latency
+        self.setup_seconds = setup_seconds
+        self.jitter = jitter
+        self.ban_workers = ban_workers
+        self.ban_probability = ban_probability
+        self.error_probability = error_probability
+        self.random = random.Random(seed)
+
+    def run_wave(self, workers, url_count, new_workers=0):
+        """Return a sample for one wave; the first new_workers start from scratch"""
+        sample = ThroughputSample(workers)
+        free_at = [self.setup_seconds if index < new_workers else 0.0 for index in range(workers)]
+        for _ in range(new_workers):
+            sample.record_setup(self.setup_seconds)
+        for _ in range(url_count):
+            seconds = self.base_latency * self.random.uniform(1 - self.jitter, 1 + self.jitter)
+            if workers > self.ban_workers and self.random.random() < self.ban_probability:
+                sample.record_ban()
+                seconds *= 2
+            sample.record(seconds, error=self.random.random() < self.error_probability)
+            free_at[free_at.index(min(free_at))] += seconds
+        sample.wall = max(free_at)
+        return sample
+
+
+def simulate(controller, marketplace, model, url_count, budget):
+    """Run one marketplace pass against a model; return (elapsed, bans)"""
+    pending = url_count
+    elapsed = 0.0
+    bans = 0
+    live_workers = 0
+    controller.observe(marketplace, ThroughputSample(), pending, budget)
+    while pending:
+        workers, wave_size = controller.plan(marketplace)
+        wave = min(workers * wave_size, pending)
+        pending -= wave
+        # Workers surviving from the last wave keep their browsers
+        sample = model.run_wave(workers, wave, max(0, workers - live_workers))
+        live_workers = workers
+        elapsed += sample.wall
+        bans += sample.bans
+        controller.observe(marketplace, sample, pending, budget - elapsed)
+    return elapsed, bans
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    controller = AdaptiveController(resource_probe=lambda: (0.5, 0.5))
+    models = {
+        'kaspi': SimulatedMarketplace(4.0, seed=1),
+        'alibaba': SimulatedMarketplace(2.5, seed=2),
+        'wildberries': SimulatedMarketplace(12.0, ban_workers=5, seed=3),
+        'ozon': SimulatedMarketplace(6.0, seed=4)
+    }
+    url_counts = {'kaspi': 300, 'alibaba': 300, 'wildberries': 100, 'ozon': 150}
+    budget = 900.0 / len(models)
+    # State carries over between cycles, as it does in main()
+    for cycle in range(1, 4):
+        for marketplace, model in models.items():
+            elapsed, bans = simulate(controller, marketplace, model, url_counts[marketplace], budget)
+            print(f"cycle {cycle} {marketplace}: {url_counts[marketplace]} urls in {elapsed:.0f}s "
+                  f"of {budget:.0f}s budget, {bans} bans, final workers {controller.plan(marketplace)[0]}")
@@ -0,0 +1,39 @@
+import json
+import re
+import logging
+
+# Kaspi embeds page state as `BACKEND.components.<name> = {...};` script assignments
+COMPONENT_PATTERN = re.compile(r'BACKEND\.components\.(\w+)\s*=\s*')
+
+_decoder = json.JSONDecoder()
+
+
+def iter_backend_components(html, names=None):
+    """Yield (name, value) for every BACKEND.components.* JSON blob in html.
+
+    Each blob is decoded in place with raw_decode starting right after the
+    assignment, so nested objects and strings containing ';' or '}' are
+    handled and the rest of the page is never copied or re-scanned.
+    """
+    wanted = set(names) if names else None
+    for match in COMPONENT_PATTERN.finditer(html):
+        name = match.group(1)
+        if wanted is not None and name not in wanted:
+            continue
+        try:
+            value, _ = _decoder.raw_decode(html, match.end())
+        except ValueError as e:
+            logging.debug(f"Could not decode BACKEND.components.{name}: {e}")
+            continue
+        yield name, value
+
+
+def extract_backend_components(html, names=None):
+    """Return a dict of the BACKEND.components.* blobs found in html"""
+    components = {}
+    wanted = set(names) if names else None
+    for name, value in iter_backend_components(html, names):
+        components.setdefault(name, value)
+        if wanted is not None and wanted.issubset(components):
+            break
+    return components
@@ -0,0 +1,307 @@
+from contextlib import contextmanager
+import threading
+import logging
+import signal
+import time
+import os
+
+# Chrome switch tagging browsers started by this process, so orphans can be told apart
+OWNER_SWITCH = '--parser-updater-owner'
+
+# Recycle a driver once its process tree uses this much memory...
+DRIVER_MAX_RSS_MB = int(os.getenv('DRIVER_MAX_RSS_MB', '1500'))
+# ...or once it has loaded this many pages
+DRIVER_MAX_PAGES = int(os.getenv('DRIVER_MAX_PAGES', '200'))
+
+BROWSER_NAMES = ('chrome', 'chromedriver', 'google-chrome', 'chrome_crashpad')
+
+
+def _read_proc(pid, name):
+    try:
+        with open(f'/proc/{pid}/{name}', 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def list_processes():
+    """Return {pid: (ppid, name, cmdline)} for every process in /proc"""
+    processes = {}
+    try:
+        pids = [int(entry) for entry in os.listdir('/proc') if entry.isdigit()]
+    except OSError:
+        return processes
+    for pid in pids:
+        stat = _read_proc(pid, 'stat')
+        if stat is None:
+            continue
+        # The name is wrapped in parentheses and may itself contain spaces
+        stat = stat.decode(errors='replace')
+        name = stat[stat.index('(') + 1:stat.rindex(')')]
+        ppid = int(stat[stat.rindex(')') + 2:].split()[1])
+        cmdline = (_read_proc(pid, 'cmdline') or b'').replace(b'\0', b' ').decode(errors='replace').strip()
+        processes[pid] = (ppid, name, cmdline)
+    return processes
+
+
+def process_tree(root_pid, processes=None):
+    """Return root_pid and all of its descendants that are still alive"""
+    processes = processes if processes is not None else list_processes()
+    children = {}
+    for pid, (ppid, _, _) in processes.items():
+        children.setdefault(ppid, []).append(pid)
+    tree = []
+    stack = [root_pid] if root_pid in processes else []
+    while stack:
+        pid = stack.pop()
+        tree.append(pid)
+        stack.extend(children.get(pid, []))
+    return tree
+
+
+def process_rss(pid):
+    """Resident set size of pid in bytes, 0 if it is gone"""
+    status = _read_proc(pid, 'status')
+    if status is None:
+        return 0
+    for line in status.decode(errors='replace').splitlines():
+        if line.startswith('VmRSS:'):
+            return int(line.split()[1]) * 1024
+    return 0
+
+
+def process_pss(pid):
+    """Proportional set size of pid in bytes, falling back to RSS without smaps_rollup.
+
+    Shared pages are split between the processes mapping them, so PSS can be
+    summed over a Chrome tree without counting shared libraries and shared
+    memory once per process as RSS does.
+    """
+    rollup = _read_proc(pid, 'smaps_rollup')
+    if rollup is not None:
+        for line in rollup.decode(errors='replace').splitlines():
+            if line.startswith('Pss:'):
+                return int(line.split()[1]) * 1024
+    return process_rss(pid)
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def kill_pids(pids, grace=3.0):
+    """SIGTERM pids, then SIGKILL whatever is left after grace seconds"""
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except (ProcessLookupError, PermissionError):
+            pass
+    deadline = time.time() + grace
+    while time.time() < deadline and any(pid_alive(pid) for pid in pids):
+        time.sleep(0.1)
+    for pid in pids:
+        if pid_alive(pid):
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                pass
+
+
+class DriverRecord:
+    def __init__(self, driver_pid):
+        self.driver_pid = driver_pid
+        self.started_at = time.time()
+        self.pages = 0
+        self.rss = 0
+        self.first_rss = 0
+        self.peak_rss = 0
+
+    @property
+    def growth(self):
+        """Memory gained since the first page, in bytes"""
+        return max(0, self.rss - self.first_rss)
+
+
+class DriverSupervisor:
+    """Track the chromedriver/chrome process tree behind every live driver.
+
+    Parsers register each driver they start and report every page load.
+    The supervisor samples the memory of each driver's process tree (PSS,
+    though fields and metrics keep their rss names), tells the parser when
+    to recycle it, kills whatever survives driver.quit(), and reaps browsers
+    left behind by crashed threads or earlier runs.
+    """
+
+    def __init__(self, max_rss_mb=DRIVER_MAX_RSS_MB, max_pages=DRIVER_MAX_PAGES):
+        self.max_rss = max_rss_mb * 1024 * 1024
+        self.max_pages = max_pages
+        self._drivers = {}
+        self._lock = threading.Lock()
+        self._launching = 0
+        self.drivers_started = 0
+        self.drivers_recycled = 0
+        self.orphans_reaped = 0
+        # Totals over drivers that have already been quit
+        self.retired_drivers = 0
+        self.retired_pages = 0
+        self.retired_growth = 0
+        self.retired_peak_rss = 0
+
+    @contextmanager
+    def launching(self):
+        """Wrap driver start-up so reaping never kills a browser mid-launch"""
+        with self._lock:
+            self._launching += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._launching -= 1
+
+    @staticmethod
+    def driver_pid(driver):
+        try:
+            return driver.service.process.pid
+        except AttributeError:
+            return None
+
+    def register(self, driver):
+        pid = self.driver_pid(driver)
+        with self._lock:
+            self._drivers[id(driver)] = DriverRecord(pid)
+            self.drivers_started += 1
+        logging.info(f"Supervising driver pid {pid}")
+
+    def page_loaded(self, driver):
+        """Count a page load and sample the driver's memory"""
+        with self._lock:
+            record = self._drivers.get(id(driver))
+        if record is None:
+            return
+        record.pages += 1
+        record.rss = sum(process_pss(pid) for pid in process_tree(record.driver_pid))
+        if record.pages == 1:
+            record.first_rss = record.rss
+        record.peak_rss = max(record.peak_rss, record.rss)
+
+    def should_recycle(self, driver):
+        """Return the reason to recycle driver, or None"""
+        with self._lock:
+            record = self._drivers.get(id(driver))
+        if record is None:
+            return None
+        if record.rss >= self.max_rss:
+            return f"rss {record.rss / 2**20:.0f}MB over {self.max_rss / 2**20:.0f}MB"
+        if record.pages >= self.max_pages:
+            return f"{record.pages} pages loaded"
+        return None
+
+    def quit(self, driver, recycled=False):
+        """Quit driver and kill any of its processes that outlive quit()"""
+        with self._lock:
+            record = self._drivers.pop(id(driver), None)
+        tree = process_tree(record.driver_pid) if record and record.driver_pid else []
+        try:
+            driver.quit()
+        except Exception as e:
+            logging.error(f"Failed to quit driver: {e}")
+
+        survivors = [pid for pid in tree if pid_alive(pid)]
+        if survivors:
+            logging.warning(f"Killing {len(survivors)} browser processes left after quit")
+            kill_pids(survivors)
+
+        if record is not None:
+            with self._lock:
+                self.retired_drivers += 1
+                self.retired_pages += record.pages
+                self.retired_growth += record.growth
+                self.retired_peak_rss += record.peak_rss
+                if recycled:
+                    self.drivers_recycled += 1
+            logging.info(
+                f"Driver pid {record.driver_pid} quit after {record.pages} pages, "
+                f"peak rss {record.peak_rss / 2**20:.0f}MB"
+            )
+
+    def reap_orphans(self):
+        """Kill browsers whose owner is dead or that no live driver accounts for.
+
+        Only processes carrying OWNER_SWITCH, and the chromedriver that
+        launched them, are touched; other Chrome instances on the host are not.
+        """
+        processes = list_processes()
+        with self._lock:
+            # Our own untracked browsers may still be registering
+            skip_own = self._launching > 0
+            tracked = set()
+            for record in self._drivers.values():
+                if record.driver_pid:
+                    tracked.update(process_tree(record.driver_pid, processes))
+
+        my_pid = os.getpid()
+        orphans = set()
+        for pid, (ppid, name, cmdline) in processes.items():
+            if pid in tracked or not name.startswith(BROWSER_NAMES):
+                continue
+            for arg in cmdline.split():
+                if arg.startswith(f'{OWNER_SWITCH}='):
+                    try:
+                        owner = int(arg.split('=', 1)[1])
+                    except ValueError:
+                        break
+                    if (owner == my_pid and not skip_own) or (owner != my_pid and not pid_alive(owner)):
+                        orphans.update(process_tree(pid, processes))
+                        # The chromedriver that launched this browser is orphaned with it
+                        parent = processes.get(ppid)
+                        if parent is not None and parent[1] == 'chromedriver':
+                            orphans.update(process_tree(ppid, processes))
+                    break
+
+        orphans -= tracked
+        if orphans:
+            logging.warning(f"Reaping {len(orphans)} orphaned browser processes")
+            kill_pids(sorted(orphans))
+            with self._lock:
+                self.orphans_reaped += len(orphans)
+        return len(orphans)
+
+    def metrics(self):
+        """Per-driver memory, plus RSS growth per page and peak RSS per driver overall"""
+        with self._lock:
+            records = list(self._drivers.values())
+            drivers = self.retired_drivers + len(records)
+            pages = self.retired_pages + sum(record.pages for record in records)
+            growth = self.retired_growth + sum(record.growth for record in records)
+            peak_rss = self.retired_peak_rss + sum(record.peak_rss for record in records)
+            return {
+                'live_drivers': len(records),
+                'drivers_started': self.drivers_started,
+                'drivers_recycled': self.drivers_recycled,
+                'orphans_reaped': self.orphans_reaped,
+                'live_rss_mb': round(sum(record.rss for record in records) / 2**20, 1),
+                'pages': pages,
+                'growth_mb_per_page': round(growth / 2**20 / pages, 2) if pages else 0.0,
+                'avg_peak_rss_mb': round(peak_rss / 2**20 / drivers, 1) if drivers else 0.0,
+                'drivers': [
+                    {
+                        'pid': record.driver_pid,
+                        'pages': record.pages,
+                        'rss_mb': round(record.rss / 2**20, 1),
+                        'peak_rss_mb': round(record.peak_rss / 2**20, 1),
+                        'growth_mb_per_page': round(record.growth / 2**20 / record.pages, 2) if record.pages else 0.0,
+                        'age_seconds': round(time.time() - record.started_at)
+                    }
+                    for record in records
+                ]
+            }
+
+
+# Shared by every MarketplaceParser in the process
+supervisor = DriverSupervisor()
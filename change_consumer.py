@@ -0,0 +1,105 @@
+from db_handler import connect, CHANGE_CHANNEL
+import psycopg2.extras
+import select
+import logging
+
+
+class ChangeConsumer:
+    """Tail the product_changes outbox by id.
+
+    NOTIFY on the product_changes channel is only used as a wake-up signal:
+    every event is read back from the outbox, so nothing is lost while the
+    consumer is down, and a named consumer resumes from its stored cursor.
+
+        consumer = ChangeConsumer('price-alerts')
+        for change in consumer.iter_changes():
+            handle(change)
+    """
+
+    def __init__(self, name=None, cursor_id=None, batch_size=500, conn=None):
+        self.name = name
+        self.batch_size = batch_size
+        self.conn = conn or connect()
+        self.conn.autocommit = True
+        self._listening = False
+
+        if cursor_id is None:
+            cursor_id = self.load_cursor() if name else 0
+        self.cursor_id = cursor_id
+
+    def load_cursor(self):
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT last_change_id FROM change_consumers WHERE name = %s", (self.name,))
+            row = cur.fetchone()
+            return row[0] if row else 0
+
+    def commit(self):
+        """Persist the cursor for a named consumer"""
+        if not self.name:
+            return
+        with self.conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO change_consumers (name, last_change_id)
+                VALUES (%s, %s)
+                ON CONFLICT (name) DO UPDATE SET
+                    last_change_id = EXCLUDED.last_change_id,
+                    updated_at = CURRENT_TIMESTAMP
+            """, (self.name, self.cursor_id))
+
+    def fetch(self, limit=None):
+        """Return the next batch of changes after the cursor and advance it"""
+        with self.conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute("""
+                SELECT id, marketplace, product_id, product_url, changes, created_at
+                FROM product_changes
+                WHERE id > %s
+                ORDER BY id
+                LIMIT %s
+            """, (self.cursor_id, limit or self.batch_size))
+            changes = cur.fetchall()
+        if changes:
+            self.cursor_id = changes[-1]['id']
+        return changes
+
+    def listen(self):
+        if not self._listening:
+            with self.conn.cursor() as cur:
+                cur.execute(f"LISTEN {CHANGE_CHANNEL}")
+            self._listening = True
+
+    def wait(self, timeout=5.0):
+        """Block until a NOTIFY arrives or timeout passes; True if notified"""
+        self.listen()
+        if select.select([self.conn], [], [], timeout) == ([], [], []):
+            return False
+        self.conn.poll()
+        notified = bool(self.conn.notifies)
+        self.conn.notifies.clear()
+        return notified
+
+    def iter_changes(self, timeout=5.0):
+        """Yield changes forever, committing the cursor after each batch"""
+        # LISTEN before draining so a change committed in between still wakes us
+        self.listen()
+        while True:
+            changes = self.fetch()
+            for change in changes:
+                yield change
+            if changes:
+                self.commit()
+                if len(changes) == self.batch_size:
+                    continue
+            self.wait(timeout)
+
+    def close(self):
+        self.conn.close()
+
+
+if __name__ == "__main__":
+    import json
+    import sys
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    consumer = ChangeConsumer(sys.argv[1] if len(sys.argv) > 1 else None)
+    for change in consumer.iter_changes():
+        print(json.dumps(change, default=str, ensure_ascii=False), flush=True)
@@ -1,18 +1,81 @@
 import psycopg2
+import psycopg2.extras
 from dotenv import load_dotenv
 import os
+import json
 import logging
 load_dotenv()
 
+PRODUCT_TABLES = {
+    'kaspi': 'kaspi_products',
+    'alibaba': 'alibaba_products',
+    'wildberries': 'wildberries_products',
+    'ozon': 'ozon_products'
+}
+
+# Parsed columns of each table, written only when the parser returned them
+PRODUCT_COLUMNS = {
+    'kaspi': ('is_available', 'price', 'delivery_price', 'delivery_date', 'total_reviews', 'rating'),
+    'alibaba': ('is_available', 'price', 'reviews', 'rating', 'delivery_speed'),
+    'wildberries': ('is_available', 'price', 'rating', 'reviews'),
+    'ozon': ('is_available', 'price', 'rating', 'reviews')
+}
+
+# NOTIFY channel for product_changes rows
+CHANGE_CHANNEL = 'product_changes'
+# Postgres rejects NOTIFY payloads of 8000 bytes or more
+MAX_NOTIFY_PAYLOAD = 7900
+# Arbitrary advisory lock key guarding product_changes inserts
+OUTBOX_LOCK_ID = 727001
+
+# URLs that failed as 'gone' this many times in a row are skipped...
+DEAD_LETTER_THRESHOLD = int(os.getenv('DEAD_LETTER_THRESHOLD', '3'))
+# ...until their last failure is older than this, then they are retried once
+DEAD_LETTER_RETRY_HOURS = int(os.getenv('DEAD_LETTER_RETRY_HOURS', '24'))
+
+def connect():
+    """Open a connection using the DB_* environment variables"""
+    return psycopg2.connect(
+        dbname=os.getenv('DB_NAME'),
+        user=os.getenv('DB_USER'),
+        password=os.getenv('DB_PASSWORD'),
+        host=os.getenv('DB_HOST'),
+        port=os.getenv('DB_PORT')
+    )
+
+def get_products(conn, marketplace, urls=None, ids=None):
+    """Return rows of one marketplace table matching any of urls or ids"""
+    table = PRODUCT_TABLES[marketplace]
+    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        cur.execute(f"""
+            SELECT * FROM {table}
+            WHERE product_url = ANY(%s) OR id = ANY(%s)
+        """, (list(urls or []), list(ids or [])))
+        return cur.fetchall()
+
+def list_products(conn, marketplace, is_available=None, after_id=0, limit=100):
+    """Keyset page of one marketplace table ordered by id"""
+    table = PRODUCT_TABLES[marketplace]
+    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        cur.execute(f"""
+            SELECT * FROM {table}
+            WHERE id > %s AND (%s IS NULL OR is_available = %s)
+            ORDER BY id
+            LIMIT %s
+        """, (after_id, is_available, is_available, limit))
+        return cur.fetchall()
+
+def change_payload(change_id, marketplace, product_id, product_url, changes):
+    """Compact NOTIFY payload; the changes are dropped if they do not fit"""
+    header = {'id': change_id, 'm': marketplace, 'p': product_id, 'u': product_url}
+    payload = json.dumps({**header, 'c': changes}, separators=(',', ':'), ensure_ascii=False)
+    if len(payload.encode('utf-8')) > MAX_NOTIFY_PAYLOAD:
+        payload = json.dumps(header, separators=(',', ':'), ensure_ascii=False)
+    return payload
+
 class DatabaseHandler:
     def __init__(self):
-        self.conn = psycopg2.connect(
-            dbname=os.getenv('DB_NAME'),
-            user=os.getenv('DB_USER'),
-            password=os.getenv('DB_PASSWORD'),
-            host=os.getenv('DB_HOST'),
-            port=os.getenv('DB_PORT')
-        )
+        self.conn = connect()
         self.create_tables()
 
     def create_tables(self):
@@ -73,12 +136,49 @@ class DatabaseHandler:
                 )
             """)
 
+            # Dead-letter table for permanently failing URLs
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS dead_letter_urls (
+                    id SERIAL PRIMARY KEY,
+                    marketplace TEXT NOT NULL,
+                    product_url TEXT NOT NULL,
+                    failure_kind TEXT NOT NULL,
+                    failure_count INTEGER DEFAULT 1,
+                    last_error TEXT DEFAULT '',
+                    first_failed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    last_failed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    UNIQUE (marketplace, product_url)
+                )
+            """)
+
+            # Outbox of real field changes, tailed by id
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS product_changes (
+                    id BIGSERIAL PRIMARY KEY,
+                    marketplace TEXT NOT NULL,
+                    product_id INTEGER NOT NULL,
+                    product_url TEXT NOT NULL,
+                    changes JSONB NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+
+            # Last change id processed by each named consumer
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS change_consumers (
+                    name TEXT PRIMARY KEY,
+                    last_change_id BIGINT DEFAULT 0,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+
             # Create indexes for better performance
             indexes = [
                 "CREATE INDEX IF NOT EXISTS idx_kaspi_url ON kaspi_products(product_url)",
                 "CREATE INDEX IF NOT EXISTS idx_alibaba_url ON alibaba_products(product_url)",
                 "CREATE INDEX IF NOT EXISTS idx_wb_url ON wildberries_products(product_url)",
-                "CREATE INDEX IF NOT EXISTS idx_ozon_url ON ozon_products(product_url)"
+                "CREATE INDEX IF NOT EXISTS idx_ozon_url ON ozon_products(product_url)",
+                "CREATE INDEX IF NOT EXISTS idx_changes_created ON product_changes(created_at)"
             ]
             
             for index in indexes:
@@ -86,114 +186,141 @@ class DatabaseHandler:
 
             self.conn.commit()
 
+    def _update_product(self, marketplace, url, fields):
+        """Write fields for url and append any real changes to the outbox.
+
+        The current row is locked and compared first, so product_changes only
+        gets a row (and listeners a NOTIFY) when a value actually changed.
+        Returns the {column: [old, new]} dict of changes.
+        """
+        table = PRODUCT_TABLES[marketplace]
+        columns = list(fields)
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute(
+                    f"SELECT id, {', '.join(columns)} FROM {table} WHERE product_url = %s FOR UPDATE",
+                    (url,)
+                )
+                row = cur.fetchone()
+                if row is None:
+                    self.conn.commit()
+                    return {}
+
+                product_id, old_values = row[0], dict(zip(columns, row[1:]))
+                changes = {
+                    column: [old_values[column], value]
+                    for column, value in fields.items()
+                    if old_values[column] != value
+                }
+
+                assignments = ', '.join(f"{column} = %s" for column in columns)
+                cur.execute(
+                    f"UPDATE {table} SET {assignments}, updated_at = CURRENT_TIMESTAMP WHERE id = %s",
+                    (*fields.values(), product_id)
+                )
+
+                if changes:
+                    # Serialize outbox inserts so ids become visible in commit order
+                    # and a consumer tailing by id never skips a late commit
+                    cur.execute("SELECT pg_advisory_xact_lock(%s)", (OUTBOX_LOCK_ID,))
+                    cur.execute("""
+                        INSERT INTO product_changes (marketplace, product_id, product_url, changes)
+                        VALUES (%s, %s, %s, %s)
+                        RETURNING id
+                    """, (marketplace, product_id, url, json.dumps(changes)))
+                    change_id = cur.fetchone()[0]
+                    cur.execute("SELECT pg_notify(%s, %s)", (
+                        CHANGE_CHANNEL, change_payload(change_id, marketplace, product_id, url, changes)
+                    ))
+                    logging.info(f"Recorded change {change_id} for {marketplace} product {product_id}: {list(changes)}")
+
+                self.conn.commit()
+        except Exception:
+            # Release the row lock and any half-written outbox row
+            self.conn.rollback()
+            raise
+        return changes
+
+    def _parsed_fields(self, marketplace, data):
+        """Columns the parser actually returned; out-of-stock pages carry no price or reviews"""
+        fields = {column: data[column] for column in PRODUCT_COLUMNS[marketplace] if column in data}
+        fields['is_available'] = data.get('is_available', False)
+        return fields
+
     def update_kaspi_product(self, data):
         logging.info("Updating kaspi product")
-        with self.conn.cursor() as cur:
-            cur.execute("""
-                UPDATE kaspi_products SET 
-                    is_available = %s,
-                    price = %s,
-                    delivery_price = %s,
-                    delivery_date = %s,
-                    total_reviews = %s,
-                    rating = %s,
-                    updated_at = CURRENT_TIMESTAMP
-                WHERE product_url = %s
-            """, (
-                data.get('is_available', False),
-                data.get('price', 0),
-                data.get('delivery_price', ''),
-                data.get('delivery_date', ''),
-                data.get('total_reviews', 0),
-                data.get('rating', 0.0),
-                data.get('product_url')
-            ))
-            self.conn.commit()
+        return self._update_product('kaspi', data.get('product_url'), self._parsed_fields('kaspi', data))
 
     def update_alibaba_product(self, data):
         logging.info("Updating alibaba product")
-        with self.conn.cursor() as cur:
-            cur.execute("""
-                UPDATE alibaba_products SET 
-                    is_available = %s,
-                    price = %s,
-                    reviews = %s,
-                    rating = %s,
-                    delivery_speed = %s,
-                    updated_at = CURRENT_TIMESTAMP
-                WHERE product_url = %s
-            """, (
-                data.get('is_available', False),
-                data.get('price', ''),
-                data.get('reviews', '0'),
-                data.get('rating', '0'),
-                data.get('delivery_speed', ''),
-                data.get('product_url')
-            ))
-            self.conn.commit()
+        return self._update_product('alibaba', data.get('product_url'), self._parsed_fields('alibaba', data))
 
     def update_wildberries_product(self, data):
         logging.info("Updating wildberries product")
-        with self.conn.cursor() as cur:
-            cur.execute("""
-                UPDATE wildberries_products SET 
-                    is_available = %s,
-                    price = %s,
-                    rating = %s,
-                    reviews = %s,
-                    updated_at = CURRENT_TIMESTAMP
-                WHERE product_url = %s
-            """, (
-                data.get('is_available', False),
-                data.get('price', 0),
-                data.get('rating', '0'),
-                data.get('reviews', '0'),
-                data.get('product_url')
-            ))
-            self.conn.commit()
+        return self._update_product('wildberries', data.get('product_url'), self._parsed_fields('wildberries', data))
 
     def update_ozon_product(self, data):
         logging.info("Updating ozon product")
-        with self.conn.cursor() as cur:
-            cur.execute("""
-                UPDATE ozon_products SET 
-                    is_available = %s,
-                    price = %s,
-                    rating = %s,
-                    reviews = %s,
-                    updated_at = CURRENT_TIMESTAMP
-                WHERE product_url = %s
-            """, (
-                data.get('is_available', False),
-                data.get('price', 0),
-                data.get('rating', '0'),
-                data.get('reviews', '0'),
-                data.get('product_url')
-            ))
-            self.conn.commit()
+        return self._update_product('ozon', data.get('product_url'), self._parsed_fields('ozon', data))
 
     def get_kaspi_urls(self):
         logging.info("Getting kaspi urls")
         with self.conn.cursor() as cur:
-            cur.execute("SELECT product_url FROM kaspi_products")
+            cur.execute("""
+                SELECT product_url FROM kaspi_products
+                WHERE product_url NOT IN (
+                    SELECT product_url FROM dead_letter_urls
+                    WHERE marketplace = 'kaspi'
+                      AND failure_kind = 'gone'
+                      AND failure_count >= %s
+                      AND last_failed_at > CURRENT_TIMESTAMP - %s * INTERVAL '1 hour'
+                )
+            """, (DEAD_LETTER_THRESHOLD, DEAD_LETTER_RETRY_HOURS))
             return [row[0] for row in cur.fetchall()]
     
     def get_alibaba_urls(self):
         logging.info("Getting alibaba urls")
         with self.conn.cursor() as cur:
-            cur.execute("SELECT product_url FROM alibaba_products")
+            cur.execute("""
+                SELECT product_url FROM alibaba_products
+                WHERE product_url NOT IN (
+                    SELECT product_url FROM dead_letter_urls
+                    WHERE marketplace = 'alibaba'
+                      AND failure_kind = 'gone'
+                      AND failure_count >= %s
+                      AND last_failed_at > CURRENT_TIMESTAMP - %s * INTERVAL '1 hour'
+                )
+            """, (DEAD_LETTER_THRESHOLD, DEAD_LETTER_RETRY_HOURS))
             return [row[0] for row in cur.fetchall()]
     
     def get_wildberries_urls(self):
         logging.info("Getting wildberries urls")
         with self.conn.cursor() as cur:
-            cur.execute("SELECT product_url FROM wildberries_products")
+            cur.execute("""
+                SELECT product_url FROM wildberries_products
+                WHERE product_url NOT IN (
+                    SELECT product_url FROM dead_letter_urls
+                    WHERE marketplace = 'wildberries'
+                      AND failure_kind = 'gone'
+                      AND failure_count >= %s
+                      AND last_failed_at > CURRENT_TIMESTAMP - %s * INTERVAL '1 hour'
+                )
+            """, (DEAD_LETTER_THRESHOLD, DEAD_LETTER_RETRY_HOURS))
             return [row[0] for row in cur.fetchall()]
     
     def get_ozon_urls(self):
         logging.info("Getting ozon urls")
         with self.conn.cursor() as cur:
-            cur.execute("SELECT product_url FROM ozon_products")
+            cur.execute("""
+                SELECT product_url FROM ozon_products
+                WHERE product_url NOT IN (
+                    SELECT product_url FROM dead_letter_urls
+                    WHERE marketplace = 'ozon'
+                      AND failure_kind = 'gone'
+                      AND failure_count >= %s
+                      AND last_failed_at > CURRENT_TIMESTAMP - %s * INTERVAL '1 hour'
+                )
+            """, (DEAD_LETTER_THRESHOLD, DEAD_LETTER_RETRY_HOURS))
             return [row[0] for row in cur.fetchall()]
 
     def add_kaspi_url(self, url):
@@ -237,6 +364,61 @@ class DatabaseHandler:
             """, (url,))
             self.conn.commit()
 
+    def prune_changes(self, keep_days=7):
+        logging.info("Pruning product changes")
+        with self.conn.cursor() as cur:
+            cur.execute("""
+                DELETE FROM product_changes
+                WHERE created_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 day'
+            """, (keep_days,))
+            self.conn.commit()
+            return cur.rowcount
+
+    def record_failure(self, marketplace, url, failure_kind, error):
+        logging.info(f"Recording {failure_kind} failure for {marketplace} url")
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO dead_letter_urls (marketplace, product_url, failure_kind, last_error)
+                    VALUES (%s, %s, %s, %s)
+                    ON CONFLICT (marketplace, product_url) DO UPDATE SET
+                        failure_count = CASE
+                            WHEN dead_letter_urls.failure_kind = EXCLUDED.failure_kind
+                            THEN dead_letter_urls.failure_count + 1
+                            ELSE 1
+                        END,
+                        failure_kind = EXCLUDED.failure_kind,
+                        last_error = EXCLUDED.last_error,
+                        last_failed_at = CURRENT_TIMESTAMP
+                """, (marketplace, url, failure_kind, error[:1000]))
+                self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    def clear_failure(self, marketplace, url):
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute("""
+                    DELETE FROM dead_letter_urls
+                    WHERE marketplace = %s AND product_url = %s
+                """, (marketplace, url))
+                self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    def get_dead_letter_urls(self, marketplace=None):
+        logging.info("Getting dead-letter urls")
+        with self.conn.cursor() as cur:
+            cur.execute("""
+                SELECT marketplace, product_url, failure_kind, failure_count, last_error, last_failed_at
+                FROM dead_letter_urls
+                WHERE %s IS NULL OR marketplace = %s
+                ORDER BY failure_count DESC
+            """, (marketplace, marketplace))
+            return cur.fetchall()
+
     def __del__(self):
         if hasattr(self, 'conn'):
             self.conn.close() 
\ No newline at end of file
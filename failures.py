@@ -0,0 +1,111 @@
+import logging
+import random
+import time
+
+import requests
+from selenium.common.exceptions import TimeoutException, WebDriverException
+
+
+class ParseFailure(Exception):
+    """Base class for classified parsing failures"""
+    kind = 'unknown'
+    retryable = False
+
+
+class TransientFailure(ParseFailure):
+    """Timeouts and dropped connections that are worth retrying as-is"""
+    kind = 'transient'
+    retryable = True
+
+
+class BlockedFailure(ParseFailure):
+    """Anti-bot pages and refused proxies, retried on a different proxy"""
+    kind = 'blocked'
+    retryable = True
+
+
+class GoneFailure(ParseFailure):
+    """The product page no longer exists"""
+    kind = 'gone'
+
+
+class ParseDriftFailure(ParseFailure):
+    """The page loaded but the expected data was not found in it"""
+    kind = 'parse_drift'
+
+
+class UnexpectedFailure(ParseFailure):
+    """An exception that is neither I/O nor a parse problem, most likely a bug"""
+    kind = 'unexpected'
+
+
+# Chrome network errors that mean the proxy or the site refused us
+BLOCKED_NET_ERRORS = (
+    'ERR_PROXY_CONNECTION_FAILED',
+    'ERR_TUNNEL_CONNECTION_FAILED',
+    'ERR_PROXY_AUTH',
+    'ERR_BLOCKED',
+    'ERR_HTTP_RESPONSE_CODE_FAILURE',
+)
+
+
+def classify_exception(exc):
+    """Map an arbitrary exception to a ParseFailure instance"""
+    if isinstance(exc, ParseFailure):
+        return exc
+    message = str(exc)
+
+    if isinstance(exc, requests.HTTPError) and exc.response is not None:
+        status = exc.response.status_code
+        if status in (404, 410):
+            return GoneFailure(message)
+        if status in (403, 429):
+            return BlockedFailure(message)
+        return TransientFailure(message)
+    if isinstance(exc, (requests.Timeout, requests.ConnectionError, TimeoutException)):
+        return TransientFailure(message)
+    if isinstance(exc, WebDriverException):
+        if any(code in message for code in BLOCKED_NET_ERRORS):
+            return BlockedFailure(message)
+        return TransientFailure(message)
+    if isinstance(exc, OSError):
+        return TransientFailure(message)
+    if isinstance(exc, (ValueError, KeyError, IndexError)):
+        return ParseDriftFailure(message)
+    # Programming errors (AttributeError, TypeError, ...) must not be retried
+    return UnexpectedFailure(f"{type(exc).__name__}: {message}")
+
+
+def backoff_delay(attempt, base_delay=2.0, max_delay=30.0):
+    """Full-jitter exponential backoff for the given zero-based attempt"""
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+
+def run_with_retries(func, url, max_attempts=3, base_delay=2.0, max_delay=30.0, on_blocked=None):
+    """Call func(), retrying transient and blocked failures.
+
+    Transient failures are retried after a jittered backoff, blocked ones
+    after on_blocked() (e.g. a proxy rotation). Gone and parse-drift
+    failures are raised immediately, as is the last failure once
+    max_attempts is exhausted.
+    """
+    for attempt in range(max_attempts):
+        try:
+            return func()
+        except Exception as e:
+            failure = classify_exception(e)
+            if not failure.retryable or attempt == max_attempts - 1:
+                if failure is e:
+                    raise
+                raise failure from e
+
+            if isinstance(failure, BlockedFailure) and on_blocked is not None:
+                logging.warning(f"Blocked on {url} (attempt {attempt + 1}/{max_attempts}): {failure}, rotating proxy")
+                try:
+                    on_blocked()
+                except Exception as rotate_error:
+                    logging.error(f"Proxy rotation failed: {rotate_error}")
+
+            delay = backoff_delay(attempt, base_delay, max_delay)
+            logging.warning(f"{failure.kind} failure on {url} (attempt {attempt + 1}/{max_attempts}), retrying in {delay:.1f}s: {failure}")
+            time.sleep(delay)
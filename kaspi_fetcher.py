@@ -0,0 +1,226 @@
+from parser import MarketplaceParser, PROXY_LIST, classify_page
+from backend_json import extract_backend_components
+from failures import BlockedFailure, GoneFailure, ParseDriftFailure
+from requests.adapters import HTTPAdapter
+import requests
+import itertools
+import threading
+import logging
+import os
+import re
+
+USER_AGENT = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+
+DEFAULT_HEADERS = {
+    'User-Agent': USER_AGENT,
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8',
+    'Accept-Language': 'ru-RU,ru;q=0.9',
+    'Connection': 'keep-alive',
+}
+
+OFFERS_URL = 'https://kaspi.kz/yml/offer-view/offers/{product_id}'
+
+# Almaty, the city Kaspi falls back to when no ?c= is given
+DEFAULT_CITY_ID = '750000000'
+
+PRODUCT_ID_PATTERN = re.compile(r'-(\d+)/?(?:\?|$)')
+CITY_ID_PATTERN = re.compile(r'[?&]c=(\d+)')
+TITLE_PATTERN = re.compile(r'<title[^>]*>(.*?)</title>', re.IGNORECASE | re.DOTALL)
+
+
+def _expect_dict(value, name):
+    """Return value if it is a JSON object, else flag the page layout as changed"""
+    if not isinstance(value, dict):
+        raise ParseDriftFailure(f"BACKEND.components.{name} is {type(value).__name__}, expected object")
+    return value
+
+
+def _to_price(value):
+    """Whole tenge from a JSON number or a formatted string like '12 990 ₸'"""
+    if isinstance(value, bool) or value is None:
+        return 0
+    if isinstance(value, (int, float)):
+        return int(value)
+    return int(''.join(filter(str.isdigit, str(value))) or 0)
+
+
+class ChallengedError(BlockedFailure):
+    """Raised when Kaspi answers with an anti-bot page instead of the product"""
+
+
+class KaspiFetcher:
+    """Fetch Kaspi products over plain HTTP, falling back to Selenium.
+
+    Product pages embed their state as BACKEND.components.* JSON, so the
+    HTML (plus the offers endpoint) is enough to build the same dict that
+    MarketplaceParser.parse_kaspi returns, without rendering the page.
+    """
+
+    def __init__(self, proxies=None, timeout=15, use_offers_api=True):
+        self.timeout = timeout
+        self.use_offers_api = use_offers_api
+        self.proxy_user = os.getenv('PROXY_USER')
+        self.proxy_password = os.getenv('PROXY_PASSWORD')
+
+        # One keep-alive session per proxy so connections are reused per exit IP
+        proxies = list(proxies) if proxies is not None else list(PROXY_LIST)
+        self.sessions = [self._create_session(proxy) for proxy in proxies] or [self._create_session(None)]
+        self._session_cycle = itertools.cycle(self.sessions)
+        self._lock = threading.Lock()
+
+        self._fallback_parser = None
+        logging.info(f"Kaspi fetcher initialized with {len(self.sessions)} HTTP sessions")
+
+    def _create_session(self, proxy):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=0)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers.update(DEFAULT_HEADERS)
+        if proxy:
+            if self.proxy_user:
+                proxy_url = f'http://{self.proxy_user}:{self.proxy_password}@{proxy}'
+            else:
+                proxy_url = f'http://{proxy}'
+            session.proxies = {'http': proxy_url, 'https': proxy_url}
+        return session
+
+    def _next_session(self):
+        with self._lock:
+            return next(self._session_cycle)
+
+    def fetch_kaspi(self, url):
+        """Return the parsed product dict, using Selenium only when challenged"""
+        try:
+            data = self._fetch_direct(url)
+            logging.info(f"Fetched Kaspi data over HTTP: {data}")
+            return data
+        except ChallengedError as e:
+            logging.warning(f"Direct fetch challenged for {url}: {e}, falling back to Selenium")
+        except ParseDriftFailure as e:
+            logging.warning(f"Direct fetch could not parse {url}: {e}, falling back to Selenium")
+        except requests.RequestException as e:
+            logging.warning(f"Direct fetch failed for {url}: {e}, falling back to Selenium")
+        return self._fetch_with_browser(url)
+
+    def _fetch_direct(self, url):
+        session = self._next_session()
+        response = session.get(url, timeout=self.timeout)
+        html = response.text
+
+        if response.status_code in (404, 410):
+            raise GoneFailure(f"Kaspi returned {response.status_code} for {url}")
+        match = TITLE_PATTERN.search(html)
+        verdict = classify_page(match.group(1) if match else '', html)
+        if verdict == 'gone':
+            raise GoneFailure(f"Kaspi product page not found: {url}")
+        if response.status_code in (403, 429) or verdict == 'blocked':
+            raise ChallengedError(f"status {response.status_code}, {len(html)} bytes")
+        response.raise_for_status()
+
+        components = extract_backend_components(html, ['item', 'productReviews'])
+        if not components:
+            raise ChallengedError("no BACKEND.components data in page")
+
+        data = self._parse_components(url, components)
+
+        if self.use_offers_api:
+            product_id = self._product_id(url, components)
+            if product_id:
+                try:
+                    offers = self._fetch_offers(session, url, product_id)
+                    self._apply_offers(data, offers)
+                except (ChallengedError, requests.RequestException, ValueError) as e:
+                    # Offers are optional; keep what the page itself gave us
+                    logging.debug(f"Offers request failed for {url}: {e}")
+
+        if data['is_available'] and not data.get('price'):
+            raise ParseDriftFailure("No price in BACKEND.components or offers")
+        return data
+
+    def _parse_components(self, url, components):
+        # Only keys that were actually parsed, so the DB keeps the rest
+        data = {'product_url': url, 'is_available': True}
+
+        item = _expect_dict(components.get('item', {}), 'item')
+        card = _expect_dict(item.get('card', item), 'item.card')
+        price = _to_price(card.get('price') or card.get('unitPrice'))
+        if price:
+            data['price'] = price
+        if card.get('isAvailable') is False or card.get('available') is False:
+            data['is_available'] = False
+
+        reviews = _expect_dict(components.get('productReviews', {}), 'productReviews')
+        rating_data = _expect_dict(reviews.get('rating', {}), 'productReviews.rating')
+        if rating_data.get('ratingCount') is not None:
+            data['total_reviews'] = rating_data['ratingCount']
+        if rating_data.get('global') is not None:
+            data['rating'] = rating_data['global']
+        return data
+
+    def _product_id(self, url, components):
+        item = components.get('item', {})
+        card = item.get('card', {}) if isinstance(item, dict) else {}
+        if isinstance(card, dict) and card.get('id'):
+            return str(card['id'])
+        match = PRODUCT_ID_PATTERN.search(url)
+        return match.group(1) if match else None
+
+    def _fetch_offers(self, session, url, product_id):
+        match = CITY_ID_PATTERN.search(url)
+        city_id = match.group(1) if match else DEFAULT_CITY_ID
+        response = session.post(
+            OFFERS_URL.format(product_id=product_id),
+            json={'cityId': city_id, 'id': product_id, 'limit': 5, 'page': 0, 'sort': True},
+            headers={'Accept': 'application/json', 'Referer': url},
+            timeout=self.timeout
+        )
+        if response.status_code in (403, 429):
+            raise ChallengedError(f"offers endpoint returned {response.status_code}")
+        response.raise_for_status()
+        return response.json()
+
+    def _apply_offers(self, data, offers):
+        if not isinstance(offers, dict):
+            raise ValueError(f"Unexpected offers response: {type(offers).__name__}")
+        # An error-shaped or changed response must not read as "no sellers"
+        if 'offers' not in offers:
+            raise ValueError(f"No offers key in offers response: {sorted(offers)[:5]}")
+        offer_list = offers['offers']
+        if not isinstance(offer_list, list):
+            raise ValueError(f"Unexpected offers list: {type(offer_list).__name__}")
+        if not offer_list:
+            data['is_available'] = False
+            return
+        offer_list = [offer for offer in offer_list if isinstance(offer, dict)]
+        if not offer_list:
+            raise ValueError("Offers list has no offer objects")
+
+        best = min(offer_list, key=lambda offer: _to_price(offer.get('price')) or float('inf'))
+        price = _to_price(best.get('price'))
+        if price:
+            data['price'] = price
+        delivery_date = best.get('deliveryDuration') or best.get('delivery')
+        if delivery_date:
+            data['delivery_date'] = str(delivery_date)
+        delivery_price = best.get('deliveryCost', best.get('deliveryPrice'))
+        if delivery_price is not None:
+            data['delivery_price'] = str(delivery_price)
+
+    def _fetch_with_browser(self, url):
+        if self._fallback_parser is None:
+            self._fallback_parser = MarketplaceParser()
+        return self._fallback_parser.parse_kaspi(url)
+
+    def rotate_proxy(self):
+        """Rotate the Selenium fallback's proxy; HTTP sessions already round-robin"""
+        if self._fallback_parser is not None:
+            return self._fallback_parser.rotate_proxy()
+        return True
+
+    def close(self):
+        for session in self.sessions:
+            session.close()
+        if self._fallback_parser is not None:
+            self._fallback_parser.quit()
+            self._fallback_parser = None
@@ -0,0 +1,96 @@
+import argparse
+import random
+import threading
+import time
+import json
+import requests
+
+
+def sample_urls(base_url, marketplace, count):
+    """Collect product URLs to look up by paging through the read API"""
+    urls = []
+    after_id = 0
+    while len(urls) < count:
+        response = requests.get(f"{base_url}/products", params={
+            'marketplace': marketplace, 'after_id': after_id, 'limit': 1000
+        })
+        response.raise_for_status()
+        page = response.json()
+        urls.extend(row['product_url'] for row in page['items'])
+        if page['next_after_id'] is None:
+            break
+        after_id = page['next_after_id']
+    return urls[:count]
+
+
+def worker(base_url, marketplace, urls, batch_size, hot_fraction, deadline, latencies, errors):
+    session = requests.Session()
+    # Dashboards mostly ask for the same hot set of URLs
+    hot = urls[:max(1, int(len(urls) * hot_fraction))]
+    while time.monotonic() < deadline:
+        pool = hot if random.random() < 0.8 else urls
+        batch = random.sample(pool, min(batch_size, len(pool)))
+        started = time.monotonic()
+        try:
+            response = session.post(f"{base_url}/products/lookup", json={'marketplace': marketplace, 'urls': batch})
+            response.raise_for_status()
+            latencies.append(time.monotonic() - started)
+        except requests.RequestException:
+            errors.append(1)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else 0.0
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Load test the read API batch lookup endpoint")
+    arg_parser.add_argument('--base-url', default='http://localhost:8080')
+    arg_parser.add_argument('--marketplace', default='kaspi')
+    arg_parser.add_argument('--threads', type=int, default=8)
+    arg_parser.add_argument('--duration', type=float, default=30)
+    arg_parser.add_argument('--batch-size', type=int, default=50)
+    arg_parser.add_argument('--url-count', type=int, default=5000)
+    arg_parser.add_argument('--hot-fraction', type=float, default=0.1)
+    args = arg_parser.parse_args()
+
+    urls = sample_urls(args.base_url, args.marketplace, args.url_count)
+    if not urls:
+        raise SystemExit(f"No {args.marketplace} products to look up")
+
+    stats_before = requests.get(f"{args.base_url}/stats").json()
+    latencies = []
+    errors = []
+    deadline = time.monotonic() + args.duration
+    threads = [
+        threading.Thread(target=worker, args=(
+            args.base_url, args.marketplace, urls, args.batch_size,
+            args.hot_fraction, deadline, latencies, errors
+        ))
+        for _ in range(args.threads)
+    ]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    stats_after = requests.get(f"{args.base_url}/stats").json()
+
+    hits = stats_after['hits'] - stats_before['hits']
+    misses = stats_after['misses'] - stats_before['misses']
+    report = {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'requests_per_sec': round(len(latencies) / elapsed, 1),
+        'urls_per_sec': round(len(latencies) * args.batch_size / elapsed, 1),
+        'latency_p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+        'latency_p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'cache_hit_rate': round(hits / (hits + misses), 4) if hits + misses else 0.0
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
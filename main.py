@@ -1,8 +1,15 @@
 from parser import MarketplaceParser
+from kaspi_fetcher import KaspiFetcher
 from db_handler import DatabaseHandler
+from failures import ParseFailure, TransientFailure, BlockedFailure, GoneFailure, ParseDriftFailure, UnexpectedFailure, run_with_retries
+from autoscaler import AdaptiveController, ThroughputSample
+from browser_supervisor import supervisor
+from profiling import profiler, PROFILE_ENABLED
 import concurrent.futures
+import queue
 import time
 import logging
+import os
 from datetime import datetime
 
 # Setup logging
@@ -12,67 +19,178 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
-def process_urls(urls, marketplace):
-    """Process a batch of URLs for a specific marketplace"""
-    try:
-        parser = MarketplaceParser()
-        db = DatabaseHandler()
-        results = []
-        
-        for url in urls:
+# Set KASPI_DIRECT_FETCH=0 to always render Kaspi pages in Chrome
+KASPI_DIRECT_FETCH = os.getenv('KASPI_DIRECT_FETCH', '1') != '0'
+
+# Attempts per URL for transient and blocked failures
+MAX_ATTEMPTS = int(os.getenv('MAX_ATTEMPTS', '3'))
+
+# Days of product_changes history kept for consumers
+CHANGE_RETENTION_DAYS = int(os.getenv('CHANGE_RETENTION_DAYS', '7'))
+
+# Seconds between the starts of two update cycles
+CYCLE_SECONDS = 900
+
+class MarketplaceWorker:
+    """One worker thread's parser (or Kaspi fetcher) and DB connection.
+
+    Workers are kept for a whole marketplace pass and pull URLs from a shared
+    queue wave after wave, so Chrome, HTTP sessions and the DB connection are
+    set up once per worker rather than once per small batch.
+    """
+
+    def __init__(self, marketplace):
+        self.marketplace = marketplace
+        self.parser = None
+        self.fetcher = None
+        self.db = None
+        self.sample = None
+
+    def _setup(self):
+        if self.marketplace == 'kaspi' and KASPI_DIRECT_FETCH:
+            self.fetcher = KaspiFetcher()
+            self.parse = self.fetcher.fetch_kaspi
+            self.rotate_proxy = self.fetcher.rotate_proxy
+        else:
+            self.parser = MarketplaceParser()
+            self.parse = getattr(self.parser, f'parse_{self.marketplace}')
+            self.rotate_proxy = self.parser.rotate_proxy
+        self.db = DatabaseHandler()
+        self.update = getattr(self.db, f'update_{self.marketplace}_product')
+
+    def on_blocked(self):
+        self.sample.record_ban()
+        self.rotate_proxy()
+
+    def run(self, url_queue, sample):
+        """Process URLs from url_queue until it is empty, recording on sample"""
+        self.sample = sample
+        with profiler.track_batch(self.marketplace):
+            try:
+                if self.db is None:
+                    setup_start = time.time()
+                    try:
+                        self._setup()
+                    finally:
+                        sample.record_setup(time.time() - setup_start)
+
+                while True:
+                    try:
+                        url = url_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    self.process_url(url)
+            except Exception as e:
+                logging.error(f"Critical error in {self.marketplace} worker: {str(e)}", exc_info=True)
+                # Start from scratch next wave
+                self.close()
+                raise
+
+    def process_url(self, url):
+        marketplace = self.marketplace
+        sample = self.sample
+        with profiler.track_url(marketplace, url):
+            url_start = time.time()
+            # Only load-related failures count as errors for the autoscaler
+            load_error = False
             try:
-                data = None
                 logging.info(f"Starting to parse {marketplace} URL: {url}")
+
+                data = run_with_retries(
+                    lambda: self.parse(url),
+                    url,
+                    max_attempts=MAX_ATTEMPTS,
+                    on_blocked=self.on_blocked
+                )
+                self.update(data)
+                self.db.clear_failure(marketplace, url)
+
+                logging.info(f"Successfully parsed and updated {marketplace} product: {url}")
+
+            except (GoneFailure, ParseDriftFailure) as e:
+                logging.error(f"Permanent {e.kind} failure for {marketplace} product {url}: {e}")
+                try:
+                    self.db.record_failure(marketplace, url, e.kind, str(e))
+                except Exception as db_error:
+                    logging.error(f"Failed to dead-letter {url}: {db_error}")
+            except UnexpectedFailure as e:
+                logging.error(f"Unexpected error processing {marketplace} product {url}: {e}", exc_info=True)
+            except ParseFailure as e:
+                if isinstance(e, BlockedFailure):
+                    sample.record_ban()
+                load_error = isinstance(e, (TransientFailure, BlockedFailure))
+                logging.error(f"Giving up on {marketplace} product {url} after {MAX_ATTEMPTS} attempts ({e.kind}): {e}")
+            except Exception as e:
+                logging.error(f"Error processing {url}: {str(e)}", exc_info=True)
+
+            # Add delay between requests to avoid blocking
+            with profiler.stage('sleep'):
+                time.sleep(2)
+            sample.record(time.time() - url_start, error=load_error)
+
+    def close(self):
+        if self.parser is not None:
+            self.parser.quit()
+        if self.fetcher is not None:
+            self.fetcher.close()
+        if self.db is not None:
+            self.db.conn.close()
+        self.parser = self.fetcher = self.db = None
+
+def update_marketplace(marketplace, urls, controller, deadline):
+    """Process URLs in waves, re-planning the number of workers after each wave"""
+    pending = list(urls)
+    workers = []
+    controller.observe(marketplace, ThroughputSample(), len(pending), deadline - time.time())
+    
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=controller.max_workers) as executor:
+            while pending:
+                worker_count, wave_size = controller.plan(marketplace)
+                # Scale the pool, quitting the browsers of workers no longer needed
+                while len(workers) > worker_count:
+                    workers.pop().close()
+                while len(workers) < worker_count:
+                    workers.append(MarketplaceWorker(marketplace))
                 
-                if marketplace == 'kaspi':
-                    data = parser.parse_kaspi(url)
-                    if data:
-                        logging.info(f"Parsed Kaspi data: {data}")
-                        db.update_kaspi_product(data)
-                elif marketplace == 'alibaba':
-                    data = parser.parse_alibaba(url)
-                    if data:
-                        db.update_alibaba_product(data)
-                elif marketplace == 'wildberries':
-                    data = parser.parse_wildberries(url)
-                    if data:
-                        db.update_wildberries_product(data)
-                elif marketplace == 'ozon':
-                    data = parser.parse_ozon(url)
-                    if data:
-                        db.update_ozon_product(data)
+                url_queue = queue.Queue()
+                for url in pending[:worker_count * wave_size]:
+                    url_queue.put(url)
+                pending = pending[worker_count * wave_size:]
+                sample = ThroughputSample(worker_count)
+                wave_start = time.time()
                 
-                if data:
-                    logging.info(f"Successfully parsed and updated {marketplace} product: {url}")
-                    results.append(data)
-                else:
-                    logging.error(f"Failed to parse {marketplace} product: {url}")
+                futures = [executor.submit(worker.run, url_queue, sample) for worker in workers]
+                concurrent.futures.wait(futures)
+                sample.wall = time.time() - wave_start
                 
-                # Add delay between requests to avoid blocking
-                time.sleep(2)
+                # URLs left behind by workers that failed to start go back in line
+                while not url_queue.empty():
+                    pending.append(url_queue.get_nowait())
+                if not sample.urls:
+                    logging.error(f"No {marketplace} worker could start, skipping {len(pending)} URLs this cycle")
+                    break
                 
-            except Exception as e:
-                logging.error(f"Error processing {url}: {str(e)}", exc_info=True)
-                continue
-        
-        return results
-    except Exception as e:
-        logging.error(f"Critical error in process_urls: {str(e)}", exc_info=True)
-        raise
+                # Live drivers are tracked, so any other browser left is an orphan
+                supervisor.reap_orphans()
+                controller.observe(marketplace, sample, len(pending), deadline - time.time())
     finally:
-        if 'parser' in locals():
-            parser.driver.quit()
-
-def chunk_urls(urls, chunk_size=100):
-    """Split URLs into chunks"""
-    for i in range(0, len(urls), chunk_size):
-        yield urls[i:i + chunk_size]
+        for worker in workers:
+            worker.close()
 
 def main():
     db = DatabaseHandler()
+    controller = AdaptiveController()
+    
+    if PROFILE_ENABLED:
+        profiler.install()
+    
+    # Clean up browsers left behind by a previous run
+    supervisor.reap_orphans()
     
     while True:
         start_time = time.time()
+        profiler.start_cycle()
         
         try:
             # Get URLs for each marketplace
@@ -83,29 +201,37 @@ def main():
                 'ozon': db.get_ozon_urls()
             }
             
+            # Share the cycle between marketplaces by their estimated work
+            estimates = {
+                marketplace: controller.estimated_seconds(marketplace, len(urls))
+                for marketplace, urls in marketplaces.items()
+            }
+            cycle_deadline = start_time + CYCLE_SECONDS
+            
             # Process each marketplace
             for marketplace, urls in marketplaces.items():
+                remaining_work = sum(estimates.values())
+                estimate = estimates.pop(marketplace)
                 if urls:  # Добавим проверку на наличие URLs
                     logging.info(f"Starting update for {marketplace} with {len(urls)} URLs")
                     
-                    # Split URLs into chunks
-                    url_chunks = list(chunk_urls(urls))
-                    
-                    # Process chunks in parallel
-                    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
-                        futures = [
-                            executor.submit(process_urls, chunk, marketplace)
-                            for chunk in url_chunks
-                        ]
-                        concurrent.futures.wait(futures)
+                    seconds_left = max(0, cycle_deadline - time.time())
+                    deadline = time.time() + seconds_left * estimate / remaining_work
+                    update_marketplace(marketplace, urls, controller, deadline)
                     
                     logging.info(f"Completed update for {marketplace}")
                 else:
                     logging.warning(f"No URLs found for {marketplace}")
             
+            logging.info(f"Browser memory: {supervisor.metrics()}")
+            
+            # Keep the change outbox bounded
+            pruned = db.prune_changes(CHANGE_RETENTION_DAYS)
+            logging.info(f"Pruned {pruned} product changes older than {CHANGE_RETENTION_DAYS} days")
+            
             # Calculate time until next run (15 minutes = 900 seconds)
             execution_time = time.time() - start_time
-            sleep_time = max(0, 900 - execution_time)  # Changed from 1200 to 900
+            sleep_time = max(0, CYCLE_SECONDS - execution_time)
             
             logging.info(f"Update cycle completed in {execution_time:.2f} seconds")
             logging.info(f"Sleeping for {sleep_time:.2f} seconds")
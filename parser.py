@@ -4,16 +4,66 @@ from selenium.webdriver.support import expected_conditions as EC
 from datetime import datetime
 from bs4 import BeautifulSoup
 import re
-import json
 import time
 import logging
 import os
 import requests
 import random
+from backend_json import extract_backend_components
+from failures import ParseFailure, BlockedFailure, GoneFailure, ParseDriftFailure, classify_exception
+from browser_supervisor import supervisor, OWNER_SWITCH
+
+# Static list of proxies
+PROXY_LIST = [
+    "85.239.42.103:8085",
+    "85.239.42.203:8085",
+    "85.239.42.72:8085",
+    "85.239.42.57:8085",
+    "85.239.42.148:8085",
+    "85.239.42.227:8085",
+    "85.239.42.160:8085",
+    "85.239.42.80:8085",
+    "85.239.42.222:8085",
+    "85.239.42.249:8085"
+]
+
+# Whole page titles of anti-bot interstitials (compared exactly, never as substrings)
+BLOCKED_TITLES = {
+    'just a moment...',
+    'attention required! | cloudflare',
+    'access denied',
+    'доступ ограничен',
+    'доступ запрещен',
+    'вы не робот?',
+    'are you a robot?',
+    'captcha',
+    'antibot captcha',
+    'проверка браузера'
+}
+# Markup only challenge pages carry; checked on small pages only, since a
+# full product page can legitimately embed a captcha widget for a form
+CHALLENGE_MARKUP = ('g-recaptcha', 'h-captcha', 'cf-challenge', 'challenge-platform', 'smartcaptcha', 'captcha-container')
+CHALLENGE_PAGE_MAX_BYTES = 50000
+GONE_MARKERS = ('404 not found', 'ошибка 404', 'страница не найдена', 'page not found', 'товар не найден')
+
+def classify_page(title, page_source):
+    """Return 'gone', 'blocked' or None for a loaded page"""
+    title = (title or '').strip().lower()
+    if any(marker in title for marker in GONE_MARKERS):
+        return 'gone'
+    if len(page_source) < 1000 or title in BLOCKED_TITLES:
+        return 'blocked'
+    if len(page_source) < CHALLENGE_PAGE_MAX_BYTES:
+        lowered = page_source.lower()
+        if any(marker in lowered for marker in CHALLENGE_MARKUP):
+            return 'blocked'
+    return None
 
 class MarketplaceParser:
     def __init__(self):
         self.options = webdriver.ChromeOptions()
+        self.PROXY_USER = os.getenv('PROXY_USER')
+        self.PROXY_PASS = os.getenv('PROXY_PASSWORD')
         
         # Use the first proxy from the list by default
         proxies = self.get_proxy_list()
@@ -55,23 +105,33 @@ class MarketplaceParser:
         self.options.add_argument('--disable-gpu')
         self.options.add_argument('--lang=ru-RU,ru')
         
+        # Tag the browser so orphans can be traced back to a dead owner
+        self.options.add_argument(f'{OWNER_SWITCH}={os.getpid()}')
+        
         # Set Chrome binary location
         CHROME_BINARY = '/usr/bin/google-chrome-stable'
         if not os.path.exists(CHROME_BINARY):
             CHROME_BINARY = '/usr/bin/google-chrome'
         self.options.binary_location = CHROME_BINARY
 
+        self.driver = self._start_driver()
+
+    def _start_driver(self):
+        """Start Chrome with the current options and apply the stealth patches"""
+        driver = None
         try:
-            self.driver = webdriver.Chrome(options=self.options)
+            with supervisor.launching():
+                driver = webdriver.Chrome(options=self.options)
+                supervisor.register(driver)
             
             # Additional stealth using CDP
-            self.driver.execute_cdp_cmd('Network.setUserAgentOverride', {
+            driver.execute_cdp_cmd('Network.setUserAgentOverride', {
                 "userAgent": 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
                 "platform": "MacOS"
             })
             
             # Mask webdriver presence
-            self.driver.execute_cdp_cmd('Page.addScriptToEvaluateOnNewDocument', {
+            driver.execute_cdp_cmd('Page.addScriptToEvaluateOnNewDocument', {
                 'source': '''
                     Object.defineProperty(navigator, 'webdriver', {
                         get: () => undefined
@@ -85,25 +145,55 @@ class MarketplaceParser:
                 '''
             })
             
-            logging.info(f"Chrome driver initialized successfully with binary: {CHROME_BINARY}")
+            logging.info(f"Chrome driver initialized successfully with binary: {self.options.binary_location}")
+            return driver
         except Exception as e:
             logging.error(f"Failed to initialize Chrome driver: {e}")
+            if driver is not None:
+                supervisor.quit(driver)
             raise
 
+    def load_page(self, url):
+        """Navigate to url, recycling the driver first if it has outgrown its limits"""
+        reason = supervisor.should_recycle(self.driver)
+        if reason:
+            self.recycle_driver(reason)
+        self.driver.get(url)
+        supervisor.page_loaded(self.driver)
+
+    def recycle_driver(self, reason):
+        """Replace the driver with a fresh one using the same options"""
+        logging.info(f"Recycling Chrome driver: {reason}")
+        supervisor.quit(self.driver, recycled=True)
+        self.driver = self._start_driver()
+
+    def check_page(self):
+        """Raise BlockedFailure or GoneFailure if the loaded page is not a product"""
+        title = self.driver.title
+        page_source = self.driver.page_source
+        verdict = classify_page(title, page_source)
+        if verdict == 'gone':
+            raise GoneFailure(f"Product page not found: {title}")
+        if verdict == 'blocked':
+            raise BlockedFailure(f"Bot detection page '{title}' ({len(page_source)} bytes)")
+
     def parse_kaspi(self, url):
         try:
             logging.info(f"Opening URL in Chrome: {url}")
-            self.driver.get(url)
+            self.load_page(url)
             
             # Longer initial wait
             time.sleep(8)
             
             # Check if we got the anti-bot page
-            if "robots" in self.driver.page_source.lower() or len(self.driver.page_source) < 1000:
+            try:
+                self.check_page()
+            except BlockedFailure:
                 logging.error("Possible bot detection, got minimal page")
                 # Try refreshing the page
                 self.driver.refresh()
                 time.sleep(5)
+                self.check_page()
             
             # Save page source for debugging
             with open(f'page_source_{datetime.now().strftime("%Y%m%d_%H%M%S")}.html', 'w', encoding='utf-8') as f:
@@ -157,11 +247,13 @@ class MarketplaceParser:
                     logging.info(f"Found price: {data['price']}")
                 else:
                     logging.error("No price element found with any selector")
-                    data['price'] = 0
+                    raise ParseDriftFailure("No Kaspi price element found with any selector")
                     
+            except ParseFailure:
+                raise
             except Exception as e:
                 logging.error(f"Error getting price: {e}")
-                data['price'] = 0
+                raise ParseDriftFailure(f"Error getting Kaspi price: {e}") from e
 
             # Get delivery info - updated selectors
             try:
@@ -210,11 +302,10 @@ class MarketplaceParser:
                 page_source = self.driver.page_source
                 
                 # Method 1: Look for JSON data
-                reviews_pattern = r'BACKEND\.components\.productReviews\s*=\s*({[^;]+})'
-                match = re.search(reviews_pattern, page_source)
+                components = extract_backend_components(page_source, ['productReviews'])
                 
-                if match:
-                    reviews_data = json.loads(match.group(1))
+                if 'productReviews' in components:
+                    reviews_data = components['productReviews']
                     rating_data = reviews_data.get('rating', {})
                     data['total_reviews'] = rating_data.get('ratingCount', 0)
                     data['rating'] = rating_data.get('global', 0.0)
@@ -244,12 +335,13 @@ class MarketplaceParser:
 
         except Exception as e:
             logging.error(f"Error parsing Kaspi: {e}")
-            return None
+            raise classify_exception(e) from e
 
     def parse_alibaba(self, url):
         try:
-            self.driver.get(url)
+            self.load_page(url)
             time.sleep(2)
+            self.check_page()
 
             # Check availability
             try:
@@ -268,8 +360,8 @@ class MarketplaceParser:
             try:
                 price_elem = self.driver.find_element(By.CSS_SELECTOR, "div.price-list .price")
                 data['price'] = price_elem.text
-            except:
-                data['price'] = ''
+            except Exception as e:
+                raise ParseDriftFailure(f"No Alibaba price element found: {e}") from e
 
             # Get reviews and rating
             try:
@@ -292,14 +384,15 @@ class MarketplaceParser:
             return data
 
         except Exception as e:
-            print(f"Error parsing Alibaba: {e}")
-            return None
+            logging.error(f"Error parsing Alibaba: {e}")
+            raise classify_exception(e) from e
         
 
     def parse_wildberries(self, url):
         try:
-            self.driver.get(url)
+            self.load_page(url)
             time.sleep(10)
+            self.check_page()
 
             data = {
                 'product_url': url,
@@ -339,13 +432,14 @@ class MarketplaceParser:
                 if price_text:
                     # Clean price text (remove currency and spaces)
                     cleaned_price = ''.join(filter(str.isdigit, price_text))
-                    data['price'] = int(cleaned_price) if cleaned_price else 0
+                    data['price'] = int(cleaned_price)
                 else:
-                    data['price'] = 0
-                    
+                    raise ParseDriftFailure("No Wildberries price element found with any selector")
 
+            except ParseFailure:
+                raise
             except Exception as e:
-                data['price'] = 0
+                raise ParseDriftFailure(f"Error getting Wildberries price: {e}") from e
 
             # Get reviews and rating
             try:
@@ -374,12 +468,13 @@ class MarketplaceParser:
 
         except Exception as e:
             logging.error(f"Error parsing Wildberries: {e}")
-            return None
+            raise classify_exception(e) from e
 
     def parse_ozon(self, url):
         try:
-            self.driver.get(url)
+            self.load_page(url)
             time.sleep(2)
+            self.check_page()
 
             self.driver.execute_script("window.scrollTo(0, document.body.scrollHeight/2);")
             time.sleep(2)
@@ -401,15 +496,15 @@ class MarketplaceParser:
             try:
                 # find element span elemement with class l8t_27 tl8_27 l2u_27
                 price_elem = self.driver.find_element(By.CSS_SELECTOR, "span.l8t_27.tl8_27.l2u_27")
-                if price_elem:
-                    price_text = ''.join(filter(str.isdigit, price_elem.text))
-                    data['price'] = int(price_text) if price_text else 0
-                else:
-                    data['price'] = 0
+                price_text = ''.join(filter(str.isdigit, price_elem.text))
+                if not price_text:
+                    raise ParseDriftFailure(f"Ozon price element has no digits: {price_elem.text!r}")
+                data['price'] = int(price_text)
 
+            except ParseFailure:
+                raise
             except Exception as e:
-                print(f"Error getting price/stock: {e}")
-                data['price'] = 0
+                raise ParseDriftFailure(f"Error getting Ozon price: {e}") from e
             
             # Get reviews and rating
             try:
@@ -424,24 +519,12 @@ class MarketplaceParser:
             return data
 
         except Exception as e:
-            print(f"Error parsing Ozon: {e}")
-            return None
+            logging.error(f"Error parsing Ozon: {e}")
+            raise classify_exception(e) from e
 
     def get_proxy_list(self):
         """Get proxy list from provided IPs"""
-        # Static list of proxies
-        proxies = [
-            "85.239.42.103:8085",
-            "85.239.42.203:8085",
-            "85.239.42.72:8085",
-            "85.239.42.57:8085",
-            "85.239.42.148:8085",
-            "85.239.42.227:8085",
-            "85.239.42.160:8085",
-            "85.239.42.80:8085",
-            "85.239.42.222:8085",
-            "85.239.42.249:8085"
-        ]
+        proxies = list(PROXY_LIST)
         logging.info(f"Loaded {len(proxies)} proxies from static list")
         return proxies
 
@@ -450,12 +533,20 @@ class MarketplaceParser:
         proxies = self.get_proxy_list()
         if proxies:
             proxy = random.choice(proxies)
+            self.options.arguments[:] = [arg for arg in self.options.arguments if not arg.startswith('--proxy-server=')]
             self.options.add_argument(f'--proxy-server=http://{self.PROXY_USER}:{self.PROXY_PASS}@{proxy}')
-            self.driver = webdriver.Chrome(options=self.options)
+            # Quit first so two browsers never run side by side
+            supervisor.quit(self.driver)
+            self.driver = self._start_driver()
             logging.info(f"Rotated to new proxy: {proxy}")
             return True
         return False
 
+    def quit(self):
+        """Quit the driver and kill any browser processes it leaves behind"""
+        if getattr(self, 'driver', None) is not None:
+            supervisor.quit(self.driver)
+            self.driver = None
+
     def __del__(self):
-        if hasattr(self, 'driver'):
-            self.driver.quit()
+        self.quit()
@@ -0,0 +1,347 @@
+from contextlib import contextmanager, nullcontext
+from collections import defaultdict
+from datetime import datetime
+import functools
+import threading
+import argparse
+import cProfile
+import hashlib
+import logging
+import random
+import json
+import time
+import sys
+import os
+
+# Set PARSER_PROFILE=1 to record per-URL stage timings
+PROFILE_ENABLED = os.getenv('PARSER_PROFILE', '0') == '1'
+PROFILE_OUTPUT = os.getenv('PROFILE_OUTPUT', f'profile_{datetime.now().strftime("%Y%m%d")}.jsonl')
+# Fraction of URLs additionally run under a sampling profiler
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+# 'cprofile' or 'pyinstrument' (if installed)
+PROFILE_SAMPLER = os.getenv('PROFILE_SAMPLER', 'cprofile')
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+
+# Methods timed as named stages once install() runs; (module, class, attribute, stage)
+STAGE_METHODS = [
+    ('parser', 'MarketplaceParser', '__init__', 'parser_init'),
+    ('parser', 'MarketplaceParser', '_start_driver', 'driver_startup'),
+    ('parser', 'MarketplaceParser', 'parse_kaspi', 'parse'),
+    ('parser', 'MarketplaceParser', 'parse_alibaba', 'parse'),
+    ('parser', 'MarketplaceParser', 'parse_wildberries', 'parse'),
+    ('parser', 'MarketplaceParser', 'parse_ozon', 'parse'),
+    ('parser', 'MarketplaceParser', 'check_page', 'check_page'),
+    ('parser', 'MarketplaceParser', 'rotate_proxy', 'driver_startup'),
+    ('kaspi_fetcher', 'KaspiFetcher', '_fetch_direct', 'http_fetch'),
+    ('kaspi_fetcher', 'KaspiFetcher', '_fetch_offers', 'http_offers'),
+    ('browser_supervisor', 'DriverSupervisor', 'page_loaded', 'supervisor'),
+    ('browser_supervisor', 'DriverSupervisor', 'quit', 'driver_quit'),
+    ('selenium.webdriver.remote.webdriver', 'WebDriver', 'get', 'navigation'),
+    ('selenium.webdriver.remote.webdriver', 'WebDriver', 'refresh', 'navigation'),
+    ('selenium.webdriver.remote.webdriver', 'WebDriver', 'find_element', 'selectors'),
+    ('selenium.webdriver.remote.webdriver', 'WebDriver', 'find_elements', 'selectors'),
+    ('selenium.webdriver.remote.webdriver', 'WebDriver', 'execute_script', 'scripts'),
+    ('selenium.webdriver.remote.webdriver', 'WebDriver', 'page_source', 'page_source'),
+    ('selenium.webdriver.remote.webdriver', 'WebDriver', 'title', 'page_source'),
+    ('selenium.webdriver.remote.webelement', 'WebElement', 'text', 'selectors'),
+    ('selenium.webdriver.remote.webelement', 'WebElement', 'is_displayed', 'selectors'),
+]
+
+# Modules whose time.sleep calls are timed as the 'sleep' stage
+SLEEP_MODULES = ['parser', 'failures']
+
+
+class _TimedTime:
+    """Stand-in for the time module whose sleep() is recorded as a stage"""
+
+    def __init__(self, profiler):
+        self._profiler = profiler
+
+    def sleep(self, seconds):
+        with self._profiler.stage('sleep'):
+            time.sleep(seconds)
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+class Profiler:
+    """Opt-in stage timer for the parse pipeline.
+
+    Time is recorded as exclusive time per stage: a 'navigation' call made
+    inside 'parse' is charged to navigation only, so the stages of a URL add
+    up to its total. One JSON line is written per URL, per worker wave
+    (driver startup and other per-wave overhead) and per cycle (main-loop
+    DB work outside any batch).
+    """
+
+    def __init__(self, output=PROFILE_OUTPUT, sample_rate=PROFILE_SAMPLE_RATE,
+                 sampler=PROFILE_SAMPLER, profile_dir=PROFILE_DIR):
+        self.enabled = False
+        self.output = output
+        self.sample_rate = sample_rate
+        self.sampler = sampler
+        self.profile_dir = profile_dir
+        self.cycle = 0
+        # Cycles restart at 1 in every process while the output file is daily
+        self.run_id = f"{datetime.now().strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # Held while a URL runs under the sampling profiler
+        self._sampler_lock = threading.Lock()
+
+    def install(self, *extra_sleep_modules):
+        """Wrap the pipeline's methods with stage timers and start recording"""
+        if self.enabled:
+            return
+        for module_name, class_name, attribute, stage_name in STAGE_METHODS:
+            cls = getattr(__import__(module_name, fromlist=[class_name]), class_name)
+            original = cls.__dict__[attribute]
+            if isinstance(original, property):
+                setattr(cls, attribute, property(self.wrap(original.fget, stage_name)))
+            else:
+                setattr(cls, attribute, self.wrap(original, stage_name))
+
+        from db_handler import DatabaseHandler
+        for name, method in list(vars(DatabaseHandler).items()):
+            if callable(method) and name not in ('__del__', '_update_product'):
+                setattr(DatabaseHandler, name, self.wrap(method, f'db.{name.strip("_")}'))
+
+        timed_time = _TimedTime(self)
+        for module in [sys.modules[name] for name in SLEEP_MODULES] + list(extra_sleep_modules):
+            module.time = timed_time
+
+        self.enabled = True
+        logging.info(f"Profiling enabled, writing stage timings to {self.output}")
+
+    def wrap(self, func, stage_name):
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            with self.stage(stage_name):
+                return func(*args, **kwargs)
+        return timed
+
+    def _frames(self):
+        if not hasattr(self._local, 'frames'):
+            self._local.frames = []
+            self._local.record = self._new_record('cycle', None)
+        return self._local.frames
+
+    def _new_record(self, kind, marketplace, url=None):
+        return {'kind': kind, 'marketplace': marketplace, 'url': url, 'stages': defaultdict(float)}
+
+    @contextmanager
+    def _frame(self, name):
+        frames = self._frames()
+        # [stage name, start, time spent in nested stages]
+        frame = [name, time.perf_counter(), 0.0]
+        frames.append(frame)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - frame[1]
+            frames.pop()
+            self._local.record['stages'][name] += elapsed - frame[2]
+            if frames:
+                frames[-1][2] += elapsed
+
+    def stage(self, name):
+        """Context manager timing one stage of the current URL"""
+        if not self.enabled:
+            return nullcontext()
+        return self._frame(name)
+
+    def track_batch(self, marketplace):
+        """Context manager around one worker's share of a wave"""
+        if not self.enabled:
+            return nullcontext()
+        return self._track(self._new_record('batch', marketplace))
+
+    def track_url(self, marketplace, url):
+        """Context manager around everything done for one URL"""
+        if not self.enabled:
+            return nullcontext()
+        return self._track(self._new_record('url', marketplace, url), sample=True)
+
+    @contextmanager
+    def _track(self, record, sample=False):
+        self._frames()
+        outer = self._local.record
+        self._local.record = record
+        sampler = None
+        start = time.perf_counter()
+        try:
+            if sample and random.random() < self.sample_rate:
+                sampler = self._start_sampler()
+            # Time not covered by any stage is charged to 'other'
+            with self._frame('other'):
+                yield
+        finally:
+            record['total'] = time.perf_counter() - start
+            self._local.record = outer
+            if sampler is not None:
+                record['sample'] = self._stop_sampler(sampler, record)
+            self._write(record)
+
+    def start_cycle(self):
+        """Flush the calling thread's loose stage time and start a new cycle"""
+        if not self.enabled:
+            return
+        self._frames()
+        record = self._local.record
+        if record['stages']:
+            record['total'] = sum(record['stages'].values())
+            self._write(record)
+        self._local.record = self._new_record('cycle', None)
+        with self._lock:
+            self.cycle += 1
+
+    def _start_sampler(self):
+        """Start a sampler for this URL, or return None if another URL is being sampled.
+
+        Only one profiler may be active per process (Python 3.12+ raises
+        otherwise), so concurrent workers skip sampling instead of failing.
+        """
+        if not self._sampler_lock.acquire(blocking=False):
+            return None
+        try:
+            if self.sampler == 'pyinstrument':
+                try:
+                    from pyinstrument import Profiler as SamplingProfiler
+                except ImportError:
+                    logging.warning("pyinstrument is not installed, falling back to cProfile")
+                    self.sampler = 'cprofile'
+                else:
+                    sampler = SamplingProfiler(async_mode='disabled')
+                    sampler.start()
+                    return sampler
+            sampler = cProfile.Profile()
+            sampler.enable()
+            return sampler
+        except Exception as e:
+            self._sampler_lock.release()
+            logging.warning(f"Could not start {self.sampler} sampler: {e}")
+            return None
+
+    def _stop_sampler(self, sampler, record):
+        try:
+            return self._save_sample(sampler, record)
+        except Exception as e:
+            logging.warning(f"Could not save sampled profile: {e}")
+            return None
+        finally:
+            self._sampler_lock.release()
+
+    def _save_sample(self, sampler, record):
+        if isinstance(sampler, cProfile.Profile):
+            sampler.disable()
+        else:
+            sampler.stop()
+        os.makedirs(self.profile_dir, exist_ok=True)
+        digest = hashlib.sha1((record['url'] or '').encode()).hexdigest()[:10]
+        path = os.path.join(self.profile_dir, f"{self.run_id}_cycle{self.cycle}_{record['marketplace']}_{digest}")
+        if isinstance(sampler, cProfile.Profile):
+            path += '.prof'
+            sampler.dump_stats(path)
+        else:
+            path += '.html'
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(sampler.output_html())
+        return path
+
+    def _write(self, record):
+        record = dict(record, run=self.run_id, cycle=self.cycle, stages=dict(record['stages']))
+        line = json.dumps(record, ensure_ascii=False)
+        with self._lock:
+            with open(self.output, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+
+
+# Shared by main, the parsers and the DB handler
+profiler = Profiler()
+
+
+def load_records(path, cycle=None, run=None):
+    """Read stage records, keeping one cycle of one run (default: the latest run)"""
+    with open(path, encoding='utf-8') as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    if run is None and records:
+        run = records[-1].get('run')
+    records = [record for record in records if record.get('run') == run]
+    if cycle is None and records:
+        # The newest cycle is usually still running; prefer the last finished one
+        cycles = sorted({record['cycle'] for record in records})
+        cycle = cycles[-2] if len(cycles) > 1 else cycles[-1]
+    return run, cycle, [record for record in records if record['cycle'] == cycle]
+
+
+def build_report(records):
+    """Aggregate records into ranked stage totals per marketplace"""
+    report = {}
+    for record in records:
+        marketplace = record['marketplace'] or 'main loop'
+        entry = report.setdefault(marketplace, {
+            'urls': 0, 'total_seconds': 0.0, 'stages': defaultdict(float), 'url_totals': [], 'samples': []
+        })
+        # A batch's total spans its URLs, so count exclusive stage time only
+        entry['total_seconds'] += sum(record['stages'].values())
+        for name, seconds in record['stages'].items():
+            entry['stages'][name] += seconds
+        if record['kind'] == 'url':
+            entry['urls'] += 1
+            entry['url_totals'].append(record['total'])
+        if record.get('sample'):
+            entry['samples'].append(record['sample'])
+
+    for marketplace, entry in report.items():
+        url_totals = sorted(entry.pop('url_totals'))
+        total = entry['total_seconds'] or 1.0
+        entry['stages'] = [
+            {
+                'stage': name,
+                'seconds': round(seconds, 3),
+                'share': round(seconds / total, 4),
+                'per_url': round(seconds / entry['urls'], 3) if entry['urls'] else None
+            }
+            for name, seconds in sorted(entry['stages'].items(), key=lambda item: item[1], reverse=True)
+        ]
+        entry['total_seconds'] = round(entry['total_seconds'], 3)
+        entry['url_p50'] = round(url_totals[len(url_totals) // 2], 3) if url_totals else None
+        entry['url_p95'] = round(url_totals[min(len(url_totals) - 1, int(len(url_totals) * 0.95))], 3) if url_totals else None
+    return report
+
+
+def format_report(run, cycle, report):
+    lines = [f"Stage time report for run {run}, cycle {cycle}"]
+    for marketplace, entry in sorted(report.items(), key=lambda item: item[1]['total_seconds'], reverse=True):
+        lines.append('')
+        lines.append(
+            f"{marketplace}: {entry['urls']} urls, {entry['total_seconds']:.1f}s total"
+            + (f", url p50 {entry['url_p50']:.2f}s, p95 {entry['url_p95']:.2f}s" if entry['urls'] else '')
+        )
+        for stage in entry['stages']:
+            per_url = f"{stage['per_url']:8.3f}s/url" if stage['per_url'] is not None else ''
+            lines.append(f"  {stage['stage']:<28} {stage['seconds']:10.2f}s {stage['share']:7.1%} {per_url}")
+        for sample in entry['samples']:
+            lines.append(f"  sampled profile: {sample}")
+    return '\n'.join(lines)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Rank pipeline stages by time for one update cycle")
+    arg_parser.add_argument('path', nargs='?', default=PROFILE_OUTPUT, help="stage timings written with PARSER_PROFILE=1")
+    arg_parser.add_argument('--run', help="run id to report (default: the latest run in the file)")
+    arg_parser.add_argument('--cycle', type=int, help="cycle to report (default: last finished)")
+    arg_parser.add_argument('--format', choices=['text', 'json'], default='text')
+    args = arg_parser.parse_args()
+
+    run, cycle, records = load_records(args.path, args.cycle, args.run)
+    report = build_report(records)
+    if args.format == 'json':
+        print(json.dumps({'run': run, 'cycle': cycle, 'marketplaces': report}, indent=2, ensure_ascii=False))
+    else:
+        print(format_report(run, cycle, report))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,331 @@
+from db_handler import PRODUCT_TABLES, CHANGE_CHANNEL, connect, get_products, list_products
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+import threading
+import select
+import queue
+import json
+import time
+import logging
+import os
+
+# Hostname fragments used to route URL lookups without a marketplace
+MARKETPLACE_HOSTS = {
+    'kaspi.kz': 'kaspi',
+    'alibaba.com': 'alibaba',
+    'wildberries': 'wildberries',
+    'wb.ru': 'wildberries',
+    'ozon': 'ozon'
+}
+
+MAX_BATCH = 1000
+MAX_PAGE = 1000
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after ttl seconds"""
+
+    def __init__(self, max_size=10000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            if self._data.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._data)
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'invalidations': self.invalidations
+            }
+
+
+class ProductReader:
+    """Cached read access to the *_products tables.
+
+    Rows are cached per (marketplace, 'url'|'id', key). Listing pages are
+    cached under a per-marketplace generation number, so a change only has to
+    bump the generation for stale pages to stop being served.
+    """
+
+    def __init__(self, pool_size=4, cache_size=10000, ttl=60):
+        self.cache = TTLCache(cache_size, ttl)
+        self.generations = {marketplace: 0 for marketplace in PRODUCT_TABLES}
+        # Plain read-only connections; the writer owns the schema
+        self._pool = queue.Queue()
+        for _ in range(pool_size):
+            conn = connect()
+            conn.autocommit = True
+            self._pool.put(conn)
+
+    def _with_conn(self, func):
+        conn = self._pool.get()
+        try:
+            return func(conn)
+        finally:
+            self._pool.put(conn)
+
+    def lookup(self, marketplace, urls=(), ids=()):
+        """Return (rows, missing) for a batch of URLs and/or product ids"""
+        found = {}
+        missing_urls = []
+        missing_ids = []
+        for url in urls:
+            row = self.cache.get((marketplace, 'url', url))
+            if row is None:
+                missing_urls.append(url)
+            else:
+                found[row['id']] = row
+        for product_id in ids:
+            row = self.cache.get((marketplace, 'id', product_id))
+            if row is None:
+                missing_ids.append(product_id)
+            else:
+                found[row['id']] = row
+
+        if missing_urls or missing_ids:
+            generation = self.generations[marketplace]
+            rows = self._with_conn(lambda conn: get_products(conn, marketplace, missing_urls, missing_ids))
+            # Skip caching if a change arrived while we were reading
+            cacheable = generation == self.generations[marketplace]
+            for row in rows:
+                row = serialize_row(marketplace, row)
+                if cacheable:
+                    self.cache.set((marketplace, 'url', row['product_url']), row)
+                    self.cache.set((marketplace, 'id', row['id']), row)
+                found[row['id']] = row
+
+        found_urls = {row['product_url'] for row in found.values()}
+        missing = [url for url in urls if url not in found_urls]
+        missing += [product_id for product_id in ids if product_id not in found]
+        return list(found.values()), missing
+
+    def list(self, marketplace, is_available=None, after_id=0, limit=100):
+        key = (marketplace, 'page', self.generations[marketplace], is_available, after_id, limit)
+        rows = self.cache.get(key)
+        if rows is None:
+            rows = self._with_conn(lambda conn: list_products(conn, marketplace, is_available, after_id, limit))
+            rows = [serialize_row(marketplace, row) for row in rows]
+            self.cache.set(key, rows)
+        return rows
+
+    def invalidate(self, marketplace, product_id=None, product_url=None):
+        self.cache.invalidate((marketplace, 'id', product_id))
+        self.cache.invalidate((marketplace, 'url', product_url))
+        self.generations[marketplace] += 1
+
+    def listen_for_changes(self):
+        """Invalidate cached rows on every product_changes NOTIFY from the writer"""
+        while True:
+            conn = None
+            try:
+                conn = connect()
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {CHANGE_CHANNEL}")
+                # Anything could have changed while we were not listening
+                self.cache.clear()
+                logging.info(f"Listening for {CHANGE_CHANNEL} notifications")
+
+                while True:
+                    if select.select([conn], [], [], 30) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        change = json.loads(notify.payload)
+                        self.invalidate(change['m'], change.get('p'), change.get('u'))
+            except Exception as e:
+                logging.error(f"Change listener failed, reconnecting: {e}")
+                if conn is not None:
+                    conn.close()
+                time.sleep(5)
+
+    def stats(self):
+        return self.cache.stats()
+
+
+def serialize_row(marketplace, row):
+    row = {key: value.isoformat() if hasattr(value, 'isoformat') else value for key, value in row.items()}
+    row['marketplace'] = marketplace
+    return row
+
+
+def marketplace_for_url(url):
+    host = urlparse(url).netloc.lower()
+    for fragment, marketplace in MARKETPLACE_HOSTS.items():
+        if fragment in host:
+            return marketplace
+    return None
+
+
+def parse_bool(value):
+    if value is None:
+        return None
+    return value.lower() in ('1', 'true', 'yes')
+
+
+class BadRequest(Exception):
+    pass
+
+
+class ReadAPIHandler(BaseHTTPRequestHandler):
+    reader = None
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+        if parsed.path == '/health':
+            self._send(200, {'status': 'ok'})
+        elif parsed.path == '/stats':
+            self._send(200, self.reader.stats())
+        elif parsed.path == '/products':
+            self._handle(lambda: self._list(params))
+        else:
+            self._send(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/products/lookup':
+            self._send(404, {'error': 'not found'})
+            return
+        self._handle(self._lookup)
+
+    def _list(self, params):
+        marketplace = params.get('marketplace')
+        if marketplace not in PRODUCT_TABLES:
+            raise BadRequest(f"marketplace must be one of {sorted(PRODUCT_TABLES)}")
+        limit = int(params.get('limit', 100))
+        if not 1 <= limit <= MAX_PAGE:
+            raise BadRequest(f"limit must be between 1 and {MAX_PAGE}")
+        after_id = int(params.get('after_id', 0))
+        if after_id < 0:
+            raise BadRequest("after_id must not be negative")
+        rows = self.reader.list(marketplace, parse_bool(params.get('available')), after_id, limit)
+        next_after_id = rows[-1]['id'] if len(rows) == limit else None
+        return {'items': rows, 'next_after_id': next_after_id}
+
+    def _lookup(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length) or b'{}')
+        if not isinstance(body, dict):
+            raise BadRequest("body must be a JSON object")
+        urls = body.get('urls', [])
+        ids = body.get('ids', [])
+        marketplace = body.get('marketplace')
+        is_available = body.get('available')
+        if not isinstance(urls, list) or not all(isinstance(url, str) for url in urls):
+            raise BadRequest("urls must be a list of strings")
+        # bool is a subclass of int, but true/false are not product ids
+        if not isinstance(ids, list) or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+            raise BadRequest("ids must be a list of integers")
+        if is_available is not None and not isinstance(is_available, bool):
+            raise BadRequest("available must be true or false")
+        if len(urls) + len(ids) > MAX_BATCH:
+            raise BadRequest(f"at most {MAX_BATCH} urls and ids per request")
+        if marketplace is not None and marketplace not in PRODUCT_TABLES:
+            raise BadRequest(f"marketplace must be one of {sorted(PRODUCT_TABLES)}")
+        if ids and marketplace is None:
+            raise BadRequest("marketplace is required for id lookups")
+
+        # Group URLs by marketplace when the caller did not give one
+        groups = {}
+        missing = []
+        for url in urls:
+            url_marketplace = marketplace or marketplace_for_url(url)
+            if url_marketplace is None:
+                missing.append(url)
+            else:
+                groups.setdefault(url_marketplace, []).append(url)
+        if ids:
+            groups.setdefault(marketplace, [])
+
+        items = []
+        for group_marketplace, group_urls in groups.items():
+            rows, group_missing = self.reader.lookup(
+                group_marketplace, group_urls, ids if group_marketplace == marketplace else ()
+            )
+            items.extend(rows)
+            missing.extend(group_missing)
+
+        if is_available is not None:
+            items = [row for row in items if row['is_available'] == is_available]
+        return {'items': items, 'missing': missing}
+
+    def _handle(self, func):
+        try:
+            self._send(200, func())
+        except (BadRequest, ValueError) as e:
+            self._send(400, {'error': str(e)})
+        except Exception as e:
+            logging.error(f"Error serving {self.path}: {e}", exc_info=True)
+            self._send(500, {'error': 'internal error'})
+
+    def _send(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(f"{self.address_string()} - {format % args}")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    reader = ProductReader(
+        pool_size=int(os.getenv('READ_API_DB_POOL', '4')),
+        cache_size=int(os.getenv('READ_API_CACHE_SIZE', '10000')),
+        ttl=int(os.getenv('READ_API_CACHE_TTL', '60'))
+    )
+    threading.Thread(target=reader.listen_for_changes, daemon=True).start()
+
+    ReadAPIHandler.reader = reader
+    # HTTP/1.1 keeps client connections alive between requests
+    ReadAPIHandler.protocol_version = 'HTTP/1.1'
+    host = os.getenv('READ_API_HOST', '0.0.0.0')
+    port = int(os.getenv('READ_API_PORT', '8080'))
+    server = ThreadingHTTPServer((host, port), ReadAPIHandler)
+    logging.info(f"Read API listening on {host}:{port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+from autoscaler import AdaptiveController, SimulatedMarketplace, ThroughputSample, simulate
+
+BUDGET = 225.0
+
+
+def run_cycles(models, url_counts, cycles=3):
+    controller = AdaptiveController(resource_probe=lambda: (0.5, 0.5))
+    results = []
+    for _ in range(cycles):
+        results.append({
+            marketplace: simulate(controller, marketplace, model, url_counts[marketplace], BUDGET)
+            for marketplace, model in models.items()
+        })
+    return controller, results
+
+
+def test_feasible_passes_meet_deadline_without_bans():
+    models = {
+        'kaspi': SimulatedMarketplace(4.0, seed=1),
+        'alibaba': SimulatedMarketplace(2.5, seed=2),
+        'ozon': SimulatedMarketplace(6.0, seed=4)
+    }
+    _, results = run_cycles(models, {'kaspi': 300, 'alibaba': 300, 'ozon': 150})
+    for cycle in results:
+        for marketplace, (elapsed, bans) in cycle.items():
+            assert elapsed <= BUDGET, (marketplace, elapsed)
+            assert bans == 0, (marketplace, bans)
+
+
+def test_ban_ceiling_is_remembered():
+    # Needs more workers than the site tolerates, so the pass can only run at the ceiling
+    models = {'wildberries': SimulatedMarketplace(12.0, ban_workers=5, seed=3)}
+    controller, results = run_cycles(models, {'wildberries': 100})
+    assert controller.state('wildberries').ban_ceiling == 6
+    assert controller.plan('wildberries')[0] == 5
+    for cycle in results[1:]:
+        assert cycle['wildberries'][1] == 0
+
+
+def test_large_deficit_adds_several_workers():
+    controller = AdaptiveController(resource_probe=lambda: (0.5, 0.5))
+    workers = controller.plan('kaspi')[0]
+    controller.observe('kaspi', ThroughputSample(), 300, 100)
+    assert controller.plan('kaspi')[0] == min(controller.max_workers, workers * 2)
+
+
+def test_ban_free_waves_raise_the_ceiling():
+    controller = AdaptiveController(probe_waves=2, resource_probe=lambda: (0.5, 0.5))
+    state = controller.state('ozon')
+    state.ban_ceiling = 4
+    sample = ThroughputSample(3)
+    sample.record(6.0)
+    for _ in range(2):
+        controller.observe('ozon', sample, 100, 1000)
+    assert state.ban_ceiling == 5